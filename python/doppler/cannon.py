@@ -800,9 +800,9 @@ def trim_cannon_model(model,x0=None,x1=None,w0=None,w1=None):
             omodel.append(omodel1)
     else:
         if x0 is None:
-            x0 = np.argmin(np.abs(model.dispersion-w0))
+            x0 = utils.closest_index(model.dispersion,w0)
         if x1 is None:
-            x1 = np.argmin(np.abs(model.dispersion-w1))
+            x1 = utils.closest_index(model.dispersion,w1)
         npix = x1-x0+1
         nlabels = len(model.vectorizer.label_names)
         labelled_set = np.zeros([2,nlabels])
@@ -863,15 +863,13 @@ def rebin_cannon_model(model,binsize):
         normalized_flux = np.zeros([2,npix2])
         normalized_ivar = normalized_flux.copy()*0
         omodel = tc.CannonModel(labelled_set,normalized_flux,normalized_ivar,model.vectorizer)
-        omodel._s2 = dln.rebin(model._s2[0:npix2*binsize],npix2)
+        omodel._s2 = utils.rebin(model._s2[0:npix2*binsize],npix2)
         omodel._scales = model._scales
-        omodel._theta = np.zeros((npix2,npars),np.float64)
-        for i in range(npars):
-            omodel._theta[:,i] = dln.rebin(model._theta[0:npix2*binsize,i],npix2)
+        omodel._theta = utils.rebin(model._theta[0:npix2*binsize,:],npix2).astype(np.float64,copy=False)
         omodel._design_matrix = model._design_matrix
         omodel._fiducials = model._fiducials
         if model.dispersion is not None:
-            omodel.dispersion = dln.rebin(model.dispersion[0:npix2*binsize],npix2)
+            omodel.dispersion = utils.rebin(model.dispersion[0:npix2*binsize],npix2)
         omodel.regularization = model.regularization
         if hasattr(model,'ranges') is True: omodel.ranges=model.ranges
 
@@ -1009,9 +1007,10 @@ def convolve_cannon_model(model,lsf):
             for i in range(npars):
                 omodel._theta[:,i] = convolve(model._theta[:,i],lsf,mode="reflect")
         else:
-            omodel._s2 = utils.convolve_sparse(model._s2,lsf)
-            for i in range(npars):
-                omodel._theta[:,i] = utils.convolve_sparse(model._theta[:,i],lsf)
+            # Convolve the scatter and all the coefficients at once
+            out = utils.convolve_sparse(np.hstack((model._s2.reshape(-1,1),model._theta)),lsf)
+            omodel._s2 = out[:,0].copy()
+            omodel._theta[:,:] = out[:,1:]
         omodel._scales = model._scales
         omodel._design_matrix = model._design_matrix
         omodel._fiducials = model._fiducials
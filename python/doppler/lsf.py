@@ -20,10 +20,16 @@ from astropy.coordinates import SkyCoord, EarthLocation
 import thecannon as tc
 from dlnpyutils import utils as dln, bindata
 import copy
+import collections
+import hashlib
 from . import utils
 
 _SQRTTWO = np.sqrt(2.)
 
+# Cache of GaussianLsf arrays shared across objects with the same wavelength/LSF grid
+_LSF_CACHE = collections.OrderedDict()
+_LSF_CACHE_SIZE = 8
+
 # Ignore these warnings, it's a bug
 warnings.filterwarnings("ignore", message="numpy.dtype size changed")
 warnings.filterwarnings("ignore", message="numpy.ufunc size changed")
@@ -63,9 +69,7 @@ def ghlsf(x,xcenter,params,nowings=False):
     2015-02-26 - Written based on Nidever's code in apogeereduce - Bovy (IAS)
     Heavily modified by D.Nidever to work with Nidever's translated IDL routines Jan 2020.
     """
-    # Parse x
-    if len(x.shape) == 1:
-        x = np.tile(x,(len(xcenter),1))
+    xcenter = np.asarray(xcenter)
     # Unpack the LSF parameters
     if type(params) is not dict:
         params = unpack_ghlsf_params(params)
@@ -91,22 +95,18 @@ def ghlsf(x,xcenter,params,nowings=False):
             if not nowings: ghparams[ii] *= (1.-wingparams[0])
 
     # Calculate the GH part of the LSF
-    # x is [Npix,Nlsf]
+    # x is [Nlsf] or [Npix,Nlsf], broadcast against the [Npix,1] centers
     npix = len(xcenter)
-    nlsf = x.shape[1]
-    xcenter2 = np.tile(xcenter,nlsf).reshape(nlsf,npix).T
-    xlsf = x + xcenter2   # absolute X-values
+    nlsf = x.shape[-1]
+    xlsf = x + xcenter.reshape(-1,1)   # absolute X-values
     # Flatten them for gausshermitebin()
-    xlsf = xlsf.flatten()
-    xcenter2 = xcenter2.flatten()
+    xlsf = xlsf.ravel()
     # Add in height and center for gausshermitebin() and flatten to 2D
     ghparams1 = np.empty((params['Horder']+4,len(xcenter)))
     ghparams1[0,:] = 1.0
     ghparams1[1,:] = xcenter
     ghparams1[2:,:] = ghparams
-    ghparams2 = np.empty((nlsf*npix,params['Horder']+4))
-    for i in range(params['Horder']+4):
-        ghparams2[:,i] = np.repeat(ghparams1[i,:],nlsf)
+    ghparams2 = np.repeat(ghparams1.T,nlsf,axis=0)
     out = gausshermitebin(xlsf,ghparams2,params['binsize'])
     
     # Calculate the Wing part of the LSF
@@ -115,9 +115,7 @@ def ghlsf(x,xcenter,params,nowings=False):
     wingparams1[0,:] = wingparams[0,:]
     wingparams1[1,:] = xcenter
     wingparams1[2:,:] = wingparams[1:,:]
-    wingparams2 = np.empty((nlsf*npix,params['nWpar']+1))
-    for i in range(params['nWpar']+1):
-        wingparams2[:,i] = np.repeat(wingparams1[i,:],nlsf)
+    wingparams2 = np.repeat(wingparams1.T,nlsf,axis=0)
     if not nowings : out += ghwingsbin(xlsf,wingparams2,params['binsize'],params['Wproftype'])
 
     # Reshape it to [Npix,Nlsf]
@@ -654,6 +652,46 @@ def unpack_ghlsf_params(lsfarr):
     return out
 
 
+def gausslsf(xsigma,nlsf,dtype=np.float64):
+    """
+    Helper function for GaussianLsf.array() and GaussianLsf.anyarray() that
+    computes the normalized Gaussian LSF for each pixel.
+
+    The [1,Nlsf] offsets are broadcast against the [Npix,1] sigmas and
+    the exponential is evaluated in place, so only the output array
+    is allocated at full size.
+
+    Parameters
+    ----------
+    xsigma : array
+       The Gaussian sigma in pixels for each pixel, [Npix].
+    nlsf : int
+       The number of LSF pixels (odd).
+    dtype : data-type, optional
+       The floating point type to compute the LSF in.  The default is np.float64.
+
+    Returns
+    -------
+    lsf : array
+       The LSF array normalized to unit sum for each pixel, [Npix,Nlsf].
+
+    Examples
+    --------
+    lsf = gausslsf(xsigma,nlsf)
+
+    """
+    invsig = 1.0/np.asarray(xsigma,dtype=dtype).reshape(-1,1)
+    xlsf = np.arange(-(nlsf//2),nlsf-nlsf//2,dtype=dtype)
+    lsf = np.multiply(xlsf,invsig)
+    np.square(lsf,out=lsf)
+    lsf *= -0.5
+    np.exp(lsf,out=lsf)
+    # The 1/(sqrt(2*pi)*sigma) Gaussian prefactor is not needed since
+    #  each row is normalized to unit sum anyway
+    lsf *= 1.0/np.sum(lsf,axis=1).reshape(-1,1)
+    return lsf
+
+
 # Base class for representing LSF (line spread function)
 class Lsf:
     """
@@ -699,6 +737,10 @@ class Lsf:
         self.npix = npix
         self.norder = norder
         self._sigma = sigma
+        self._sigspline = {}   # sigma interpolators/extrapolators, one per order
+        self._dw = None        # wavelength step per pixel [Npix,Norder]
+        self._dwwave = None    # wavelength array that _dw was computed from
+        self._dwkey = None     # its shape and first and last values
         self._array = None
         if (pars is None) & (sigma is None):
             if verbose is True: print('No LSF information input.  Assuming Nyquist sampling.')
@@ -707,6 +749,18 @@ class Lsf:
             self.xtype = 'Pixels'
 
             
+    def _dispersion_interp(self,order=0,inverse=False):
+        """ Return the dispersion solution interpolation for an order, set up once and reused."""
+        if getattr(self,'_dispwave',None) is not self.wave:   # new wavelengths, start over
+            self._dispwave = self.wave
+            self._dispcache = {}
+        key = (order,inverse)
+        if key not in self._dispcache:
+            wave = self.wave[:,order] if self.wave.ndim==2 else self.wave
+            self._dispcache[key] = utils.dispersion_interp(wave,inverse=inverse)
+        return self._dispcache[key]
+
+        
     def wave2pix(self,w,extrapolate=True,order=0):
         """
         Convert wavelength values to pixels using the LSF's dispersion
@@ -739,9 +793,9 @@ class Lsf:
             raise Exception("No wavelength information")
         if self.ndim==2:
             # Order is always the second dimension
-            return utils.w2p(self.wave[:,order],w,extrapolate=extrapolate)            
+            return utils.w2p(self.wave[:,order],w,extrapolate=extrapolate,interp=self._dispersion_interp(order,inverse=True))            
         else:
-            return utils.w2p(self.wave,w,extrapolate=extrapolate)
+            return utils.w2p(self.wave,w,extrapolate=extrapolate,interp=self._dispersion_interp(order,inverse=True))
 
         
     def pix2wave(self,x,extrapolate=True,order=0):
@@ -776,9 +830,9 @@ class Lsf:
             raise Exception("No wavelength information")
         if self.ndim==2:
              # Order is always the second dimension
-            return utils.p2w(self.wave[:,order],x,extrapolate=extrapolate)
+            return utils.p2w(self.wave[:,order],x,extrapolate=extrapolate,interp=self._dispersion_interp(order))
         else:
-            return utils.p2w(self.wave,x,extrapolate=extrapolate)        
+            return utils.p2w(self.wave,x,extrapolate=extrapolate,interp=self._dispersion_interp(order))        
 
         
     # Return FWHM at some positions
@@ -838,7 +892,17 @@ class Lsf:
     
     def copy(self):
         """ Create a new copy of this LSF object."""
-        return copy.deepcopy(self)
+        # The LSF array is derived from the other attributes and is replaced rather
+        #  than modified, so share it instead of copying.  The interpolator caches
+        #  get new entries, so each copy starts with its own empty ones.
+        memo = {}
+        if getattr(self,'_array',None) is not None:
+            memo[id(self._array)] = self._array
+        for name in ['_sigspline','_dispcache']:
+            value = getattr(self,name,None)
+            if value is not None:
+                memo[id(value)] = {}
+        return copy.deepcopy(self,memo)
 
 
 
@@ -916,29 +980,35 @@ class GaussianLsf(Lsf):
             else:
                 # Wavelength input
                 if xtype.lower().find('wave') > -1:
-                    x0 = np.array(x).copy()            # backup
-                    x = self.wave2pix(x0,order=order)  # convert to pixels
+                    x = self.wave2pix(x,order=order)  # convert to pixels
                 # Integer, just return the values
-                if( type(x)==int) | (np.array(x).dtype.kind=='i'):
+                if( type(x)==int) | (np.asarray(x).dtype.kind=='i'):
                     return _sigma[x]
                 # Floats, interpolate
                 else:
-                    sig = interp1d(np.arange(len(_sigma)),_sigma,kind='cubic',bounds_error=False,
-                                   fill_value=(np.nan,np.nan),assume_sorted=True)(x)
-                    # Extrapolate
+                    # Build the interpolator and the extrapolation polynomials
+                    #  once per order and reuse them
                     npix = self.npix
-                    if ((np.min(x)<0) | (np.max(x)>(npix-1))) & (extrapolate is True):
+                    if order not in self._sigspline:
                         xin = np.arange(npix)
+                        spline = interp1d(xin,_sigma,kind='cubic',bounds_error=False,
+                                          fill_value=(np.nan,np.nan),assume_sorted=True)
+                        coef1 = utils.poly_fit(xin[0:10], _sigma[0:10], 2)
+                        coef2 = utils.poly_fit(xin[npix-10:], _sigma[npix-10:], 2)
+                        self._sigspline[order] = (spline,coef1,coef2)
+                    spline,coef1,coef2 = self._sigspline[order]
+                    x = np.asarray(x)
+                    sig = spline(x)
+                    # Extrapolate
+                    if extrapolate is True:
                         # At the beginning
-                        if (np.min(x)<0):
-                            coef1 = dln.poly_fit(xin[0:10], _sigma[0:10], 2)
-                            bd1, nbd1 = dln.where(x <0)
-                            sig[bd1] = dln.poly(x[bd1],coef1)
+                        bd1 = (x < 0)
+                        if np.any(bd1):
+                            sig[bd1] = utils.poly(x[bd1],coef1)
                         # At the end
-                        if (np.max(x)>(npix-1)):
-                            coef2 = dln.poly_fit(xin[npix-10:], _sigma[npix-10:], 2)
-                            bd2, nbd2 = dln.where(x > (npix-1))
-                            sig[bd2] = dln.poly(x[bd2],coef2)
+                        bd2 = (x > (npix-1))
+                        if np.any(bd2):
+                            sig[bd2] = utils.poly(x[bd2],coef2)
                     return sig
                         
         # Need to calculate
@@ -954,21 +1024,20 @@ class GaussianLsf(Lsf):
             if xtype.lower().find('pix') > -1:
                 # Pixel LSF parameters
                 if self.xtype.lower().find('pix') > -1:
-                    return np.polyval(pars[::-1],x)
+                    return utils.poly(x,pars)
                 # Wave LSF parameters
                 else:
                     w = self.pix2wave(x,order=order)
-                    return np.polyval(pars[::-1],w)                    
+                    return utils.poly(w,pars)
             # Wavelengths input
             else:
                 # Wavelength LSF parameters
                 if self.xtype.lower().find('wave') > -1:
-                    return np.polyval(pars[::-1],x)
+                    return utils.poly(x,pars)
                 # Pixel LSF parameters
                 else:
-                    x0 = np.array(x).copy()
-                    x = self.wave2pix(x0,order=order)
-                    return np.polyval(pars[::-1],x)  
+                    x = self.wave2pix(x,order=order)
+                    return utils.poly(x,pars)
 
                 
     # Clean up bad LSF values
@@ -977,22 +1046,20 @@ class GaussianLsf(Lsf):
         if self._sigma is not None:
             smlen = np.round(self.npix // 50).astype(int)
             if smlen==0: smlen=3
-            _sigma = self._sigma.reshape(self.npix,self.norder)   # make 2D
+            _sigma = self._sigma.reshape(self.npix,self.norder)   # make 2D, same memory
             for o in range(self.norder):
                 sig = _sigma[:,o]
-                gd,ngd,bd,nbd = dln.where(sig > 0.001,comp=True)
-                if nbd>0:
+                bd = ~(sig > 0.001)
+                # Only smooth if there are bad values, fixed in place
+                if np.any(bd):
                     sig[bd] = np.nan
                     smsig = dln.gsmooth(sig,smlen)
-                    sig[bd] = smsig[bd]
-                if self.ndim==2:
-                    self._sigma[:,o] = sig
-                else:
-                    self._sigma = sig
+                    np.copyto(sig,smsig,where=bd)
+            self._sigspline = {}   # sigma values changed
 
                     
     # Return full LSF values for the spectrum
-    def array(self,order=None):
+    def array(self,order=None,dtype=np.float64):
         """
         Return the full LSF for the spectrum.
 
@@ -1002,6 +1069,9 @@ class GaussianLsf(Lsf):
            The order for which to return the full LSF array, if there are multiple
            orders.  The default is None which means the LSF array for all orders is
            returned.
+        dtype : data-type, optional
+           The floating point type of the LSF array.  The default is np.float64.
+           np.float32 halves the memory and is accurate enough for convolving models.
 
         Returns
         -------
@@ -1015,62 +1085,86 @@ class GaussianLsf(Lsf):
         """
         
         # Return what we already have
-        if self._array is not None:
+        if (self._array is not None) and (self._array.dtype==dtype):
             if (self.ndim==2) & (order is not None):
                 # [Npix,Nlsf,Norder]
                 return self._array[:,:,order]
             else:
                 return self._array
 
+        # Check the cache of arrays computed by other objects on the same grid,
+        #  keyed by a digest of the inputs with a tag and dtype for each field
+        digest = hashlib.sha1()
+        for tag,arr in [(b'wave',self.wave),(b'pars',self.pars),(b'sigma',self._sigma)]:
+            digest.update(tag)
+            if arr is None:
+                digest.update(b'None')
+                continue
+            arr = np.ascontiguousarray(arr)
+            digest.update(arr.dtype.str.encode())
+            digest.update(str(arr.shape).encode())
+            digest.update(arr)
+        key = (np.dtype(dtype).str, self.xtype.lower(), digest.digest())
+        if key in _LSF_CACHE:
+            _LSF_CACHE.move_to_end(key)
+            lsf = _LSF_CACHE[key]
+            # Keep the first array, another dtype does not replace it
+            if self._array is None: self._array = lsf
+            return lsf[:,:,order] if (self.ndim==2) & (order is not None) else lsf
+
         # Loop over orders and figure out how many Nlsf pixels we need
         #  must be same across all orders
         wave = self.wave.reshape(self.npix,self.norder)
         nlsfarr = np.zeros(self.norder,dtype=int)
         xsigma = np.zeros((self.npix,self.norder),dtype=np.float64)
+        # Wavelength step per pixel, only recomputed when the wavelength array
+        #  is replaced or its shape or end values change.  Edits to interior
+        #  values alone are not detected, replace self.wave instead.
+        if self.xtype.lower().find('wave') > -1:
+            dwkey = (self.wave.shape,self.wave.flat[0],self.wave.flat[-1])
+            if (self._dwwave is not self.wave) or (self._dwkey != dwkey):
+                dw = np.diff(wave,axis=0)
+                self._dw = np.vstack((dw,dw[-1:]))
+                self._dwwave = self.wave
+                self._dwkey = dwkey
         for o in range(self.norder):
-            x = np.arange(self.npix)
             xsig = self.sigma(order=o)
-            w = wave[:,o]
             
             # Convert sigma from wavelength to pixels, if necessary
             if self.xtype.lower().find('wave') > -1:
-                wsig = xsig.copy()
-                dw = dln.slope(w)
-                dw = np.hstack((dw,dw[-1]))            
-                xsig = wsig / dw
+                xsig = xsig / self._dw[:,o]
             xsigma[:,o] = xsig
                 
             # Figure out nLSF pixels needed, +/-3 sigma
-            nlsf = np.int(np.round(np.max(xsigma)*6))
+            nlsf = int(round(np.max(xsigma)*6))
             if nlsf % 2 == 0: nlsf+=1                   # must be odd
             nlsfarr[o] = nlsf
         nlsf = np.max(np.array(nlsfarr))
 
         # Make LSF array
-        lsf = np.zeros((self.npix,nlsf,self.norder))
+        lsf = np.zeros((self.npix,nlsf,self.norder),dtype=dtype)
         # Loop over orders
         for o in range(self.norder):
-            xlsf = np.arange(nlsf)-nlsf//2
-            xlsf2 = np.repeat(xlsf,self.npix).reshape((nlsf,self.npix)).T
-            lsf1 = np.zeros((self.npix,nlsf))
-            xsig = xsigma[:,o]
-            xsigma2 = np.repeat(xsig,nlsf).reshape((self.npix,nlsf))
-            lsf1 = np.exp(-0.5*xlsf2**2 / xsigma2**2) / (np.sqrt(2*np.pi)*xsigma2)
             # should I use gaussbin????
-            lsf1[lsf1<0.] = 0.
-            lsf1 /= np.tile(np.sum(lsf1,axis=1),(nlsf,1)).T
-            lsf[:,:,o] = lsf1
+            lsf[:,:,o] = gausslsf(xsigma[:,o],nlsf,dtype=dtype)
             
         # if only one order then reshape
         if self.ndim==1: lsf=lsf.reshape(self.npix,nlsf)
             
-        self._array = lsf   # save for next time
+        # The array is shared with other objects, so don't let anyone modify it
+        lsf.flags.writeable = False
+        _LSF_CACHE[key] = lsf
+        if len(_LSF_CACHE) > _LSF_CACHE_SIZE:
+            _LSF_CACHE.popitem(last=False)
 
-        return lsf
+        # Save for next time.  Keep the first array, another dtype is served
+        #  from the cache above and does not replace it.
+        if self._array is None: self._array = lsf
+        return lsf[:,:,order] if (self.ndim==2) & (order is not None) else lsf
 
     
     # Return LSF values using contiguous input array
-    def anyarray(self,x,xtype='pixels',order=0,original=True):
+    def anyarray(self,x,xtype='pixels',order=0,original=True,dtype=np.float64):
         """
         Return the LSF of the spectrum at specific locations or
         on a new wavelength array.
@@ -1089,6 +1183,9 @@ class GaussianLsf(Lsf):
            wavelength scale but at the centers given in "x".
            If the LSF is desired on a completely new wavelength scale
            (given by "x"), then orignal=False should be used instead.
+        dtype : data-type, optional
+           The floating point type of the LSF array.  The default is np.float64.
+           np.float32 halves the memory and is accurate enough for convolving models.
 
         Returns
         -------
@@ -1117,7 +1214,7 @@ class GaussianLsf(Lsf):
             wsigma = xsigma.copy()
             # On original wavelength scale
             if original is True:
-                w1 = self.pix2wave(np.array(x)+1,order=order)
+                w1 = self.pix2wave(np.asarray(x)+1,order=order)
                 dw = w1-w
             # New wavelength/pixel scale
             else:
@@ -1126,17 +1223,11 @@ class GaussianLsf(Lsf):
             xsigma = wsigma / dw
 
         # Figure out nLSF pixels needed, +/-3 sigma
-        nlsf = np.int(np.round(np.max(xsigma)*6))
+        nlsf = int(round(np.max(xsigma)*6))
         if nlsf % 2 == 0: nlsf+=1                   # must be odd
         
         # Make LSF array
-        lsf = np.zeros((nx,nlsf))
-        xlsf = np.arange(nlsf)-nlsf//2
-        xlsf2 = np.repeat(xlsf,nx).reshape((nlsf,nx)).T
-        xsigma2 = np.repeat(xsigma,nlsf).reshape((nx,nlsf))
-        lsf = np.exp(-0.5*xlsf2**2 / xsigma2**2) / (np.sqrt(2*np.pi)*xsigma2)
-        lsf[lsf<0.] = 0.
-        lsf /= np.tile(np.sum(lsf,axis=1),(nlsf,1)).T
+        lsf = gausslsf(xsigma,nlsf,dtype=dtype)
         
         # should I use gaussbin????
         return lsf
@@ -1269,7 +1360,7 @@ class GaussHermiteLsf(Lsf):
         for o in range(self.norder):
             lsf1 = ghlsf(xlsf,np.arange(self.npix),self.pars[:,o])
             lsf1[lsf1<0.] = 0.
-            lsf1 /= np.tile(np.sum(lsf1,axis=1),(nlsf,1)).T
+            lsf1 /= np.sum(lsf1,axis=1).reshape(-1,1)
             lsf[:,:,o] = lsf1
             
         # if only one order then reshape
@@ -1322,6 +1413,6 @@ class GaussHermiteLsf(Lsf):
         xlsf = np.arange(nlsf)-nlsf//2
         lsf = ghlsf(xlsf,x,self.pars[:,order])
         lsf[lsf<0.] = 0.
-        lsf /= np.tile(np.sum(lsf,axis=1),(nlsf,1)).T
+        lsf /= np.sum(lsf,axis=1).reshape(-1,1)
         
         return lsf
@@ -136,66 +136,65 @@ def apvisit(filename,badval=20735):
         # HISTORY AP1DVISIT:  HDU9 - Wavelength coefficients                              
         # HISTORY AP1DVISIT:  HDU10 - LSF coefficients
         # HISTORY AP1DVISIT:  HDU11 - RV catalog
-        # Get number of extensions
-        hdulist = fits.open(filename)
-        nhdu = len(hdulist)
-        hdulist.close()
-
-        # flux, err, sky, skyerr are in units of 1e-17
-        flux = fits.getdata(filename,1).T * 1e-17   # [Npix,Norder]
-        wave = fits.getdata(filename,4).T
-        lsfcoef = fits.getdata(filename,10).T
-        spec = Spec1D(flux,wave=wave,lsfpars=lsfcoef,lsftype='Gauss-Hermite',lsfxtype='Pixels')
-        spec.filename = filename
-        spec.sptype = "Visit"
-        spec.waveregime = "NIR"
-        spec.instrument = "APOGEE"        
-        spec.head = fits.getheader(filename,0)
-        spec.err = fits.getdata(filename,2).T * 1e-17  # [Npix,Norder]
-        #bad = (spec.err<=0)   # fix bad error values
-        #if np.sum(bad) > 0:
-        #    spec.err[bad] = 1e30
-        spec.bitmask = fits.getdata(filename,3).T
-        spec.sky = fits.getdata(filename,5).T * 1e-17
-        spec.skyerr = fits.getdata(filename,6).T * 1e-17
-        spec.telluric = fits.getdata(filename,7).T
-        spec.telerr = fits.getdata(filename,8).T
-        spec.wcoef = fits.getdata(filename,9).T        
-        # Create the bad pixel mask
-        # "bad" pixels:
-        #   flag = ['BADPIX','CRPIX','SATPIX','UNFIXABLE','BADDARK','BADFLAT','BADERR','NOSKY',
-        #           'LITTROW_GHOST','PERSIST_HIGH','PERSIST_MED','PERSIST_LOW','SIG_SKYLINE','SIG_TELLURIC','NOT_ENOUGH_PSF','']
-        #   badflag = [1,1,1,1,1,1,1,1,
-        #              0,0,0,0,0,0,1,0]
-        #mask = (np.bitwise_and(spec.bitmask,16639)!=0) | (np.isfinite(spec.flux)==False)
-        mask = (np.bitwise_and(spec.bitmask,badval)!=0) | (np.isfinite(spec.flux)==False)
-        # Extra masking for bright skylines
-        # Commented out in favor of using SIG_SKYLINE in bitmask
-        # This can also mask too many pixels
-        #x = np.arange(spec.npix)
-        #nsky = 4
-        ##plt.clf()
-        #for i in range(spec.norder):
-        #    sky = spec.sky[:,i]
-        #    medsky = median_filter(sky,201,mode='reflect')
-        #    medcoef = dln.poly_fit(x,medsky/np.nanmedian(medsky),2)
-        #    medsky2 = dln.poly(x,medcoef)*np.nanmedian(medsky)
-        #    skymask1 = (sky>nsky*medsky2)    # pixels Nsig above median sky
-        #    #mask[:,i] = np.logical_or(mask[:,i],skymask1)    # OR combine
-        #    #plt.plot(spec.wave[:,i],sky)
-        #    #plt.plot(spec.wave[:,i],nsky*medsky2)
-        #    #plt.plot(spec.wave[:,i],spec.flux[:,i])
-        ##plt.draw()
-        spec.mask = mask
-        # Fix NaN pixels
-        for i in range(spec.norder):
-            bd,nbd = dln.where( (np.isfinite(spec.flux[:,i])==False) | (spec.err[:,i] <= 0) )
-            if nbd>0:
-                spec.flux[bd,i] = 0.0
-                spec.err[bd,i] = 1e30
-                spec.mask[bd,i] = True
-        if (nhdu>=11):
-            spec.meta = fits.getdata(filename,11)   # catalog of RV and other meta-data
+        # Open the file once and read all the extensions from it
+        with fits.open(filename) as hdulist:
+            nhdu = len(hdulist)
+
+            # flux, err, sky, skyerr are in units of 1e-17
+            flux = hdulist[1].data.T * 1e-17   # [Npix,Norder]
+            wave = hdulist[4].data.T
+            lsfcoef = hdulist[10].data.T
+            spec = Spec1D(flux,wave=wave,lsfpars=lsfcoef,lsftype='Gauss-Hermite',lsfxtype='Pixels')
+            spec.filename = filename
+            spec.sptype = "Visit"
+            spec.waveregime = "NIR"
+            spec.instrument = "APOGEE"        
+            spec.head = hdulist[0].header
+            spec.err = hdulist[2].data.T * 1e-17  # [Npix,Norder]
+            #bad = (spec.err<=0)   # fix bad error values
+            #if np.sum(bad) > 0:
+            #    spec.err[bad] = 1e30
+            spec.bitmask = hdulist[3].data.T
+            spec.sky = hdulist[5].data.T * 1e-17
+            spec.skyerr = hdulist[6].data.T * 1e-17
+            spec.telluric = hdulist[7].data.T
+            spec.telerr = hdulist[8].data.T
+            spec.wcoef = hdulist[9].data.T        
+            # Create the bad pixel mask
+            # "bad" pixels:
+            #   flag = ['BADPIX','CRPIX','SATPIX','UNFIXABLE','BADDARK','BADFLAT','BADERR','NOSKY',
+            #           'LITTROW_GHOST','PERSIST_HIGH','PERSIST_MED','PERSIST_LOW','SIG_SKYLINE','SIG_TELLURIC','NOT_ENOUGH_PSF','']
+            #   badflag = [1,1,1,1,1,1,1,1,
+            #              0,0,0,0,0,0,1,0]
+            #mask = (np.bitwise_and(spec.bitmask,16639)!=0) | (np.isfinite(spec.flux)==False)
+            mask = (np.bitwise_and(spec.bitmask,badval)!=0) | (np.isfinite(spec.flux)==False)
+            # Extra masking for bright skylines
+            # Commented out in favor of using SIG_SKYLINE in bitmask
+            # This can also mask too many pixels
+            #x = np.arange(spec.npix)
+            #nsky = 4
+            ##plt.clf()
+            #for i in range(spec.norder):
+            #    sky = spec.sky[:,i]
+            #    medsky = median_filter(sky,201,mode='reflect')
+            #    medcoef = dln.poly_fit(x,medsky/np.nanmedian(medsky),2)
+            #    medsky2 = dln.poly(x,medcoef)*np.nanmedian(medsky)
+            #    skymask1 = (sky>nsky*medsky2)    # pixels Nsig above median sky
+            #    #mask[:,i] = np.logical_or(mask[:,i],skymask1)    # OR combine
+            #    #plt.plot(spec.wave[:,i],sky)
+            #    #plt.plot(spec.wave[:,i],nsky*medsky2)
+            #    #plt.plot(spec.wave[:,i],spec.flux[:,i])
+            ##plt.draw()
+            spec.mask = mask
+            # Fix NaN pixels
+            for i in range(spec.norder):
+                bd,nbd = dln.where( (np.isfinite(spec.flux[:,i])==False) | (spec.err[:,i] <= 0) )
+                if nbd>0:
+                    spec.flux[bd,i] = 0.0
+                    spec.err[bd,i] = 1e30
+                    spec.mask[bd,i] = True
+            if (nhdu>=11):
+                spec.meta = hdulist[11].data   # catalog of RV and other meta-data
         # Spectrum, error, sky, skyerr are in units of 1e-17
         spec.snr = spec.head["SNR"]
         if base.find("apVisit") > -1:
@@ -251,69 +250,68 @@ def apstar(filename,badval=20735):
         # HISTORY APSTAR:  HDU7 - Telluric Error                                          
         # HISTORY APSTAR:  HDU8 - LSF coefficients                                        
         # HISTORY APSTAR:  HDU9 - RV and CCF structure
-        # Get number of extensions
-        hdulist = fits.open(filename)
-        nhdu = len(hdulist)
-        hdulist.close()
-
-        # Spectrum, error, sky, skyerr are in units of 1e-17
-        #  these are 2D arrays with [Nvisit+2,Npix]
-        #  the first two are combined and the rest are the individual spectra
-
-        head1 = fits.getheader(filename,1)
-        w0 = np.float64(head1["CRVAL1"])
-        dw = np.float64(head1["CDELT1"])
-        nw = head1["NAXIS1"]
-        wave = 10**(np.arange(nw)*dw+w0)
+        # Open the file once and read all the extensions from it
+        with fits.open(filename) as hdulist:
+            nhdu = len(hdulist)
+
+            # Spectrum, error, sky, skyerr are in units of 1e-17
+            #  these are 2D arrays with [Nvisit+2,Npix]
+            #  the first two are combined and the rest are the individual spectra
+
+            head1 = hdulist[1].header
+            w0 = np.float64(head1["CRVAL1"])
+            dw = np.float64(head1["CDELT1"])
+            nw = head1["NAXIS1"]
+            wave = np.logspace(w0,w0+dw*(nw-1),nw)
         
-        # flux, err, sky, skyerr are in units of 1e-17
-        flux = fits.getdata(filename,1).T * 1e-17
-        npix,nord = flux.shape
-        lsfcoef = fits.getdata(filename,8).T
-        wave2 = np.tile(wave,nord).reshape(nord,npix).T   # make wave 2D
-        spec = Spec1D(flux,wave=wave2,lsfpars=lsfcoef,lsftype='Gauss-Hermite',lsfxtype='Pixels')
-        spec.filename = filename
-        spec.sptype = "apStar"
-        spec.waveregime = "NIR"
-        spec.instrument = "APOGEE"
-        spec.head = fits.getheader(filename,0)
-        spec.err = fits.getdata(filename,2).T * 1e-17
-        #bad = (spec.err<=0)   # fix bad error values
-        #if np.sum(bad) > 0:
-        #    spec.err[bad] = 1e30
-        spec.bitmask = fits.getdata(filename,3).T
-        spec.sky = fits.getdata(filename,4).T * 1e-17
-        spec.skyerr = fits.getdata(filename,5).T * 1e-17
-        spec.telluric = fits.getdata(filename,6).T
-        spec.telerr = fits.getdata(filename,7).T
-        spec.lsf = fits.getdata(filename,8).T
-        # Create the bad pixel mask
-        # "bad" pixels:
-        #   flag = ['BADPIX','CRPIX','SATPIX','UNFIXABLE','BADDARK','BADFLAT','BADERR','NOSKY',
-        #           'LITTROW_GHOST','PERSIST_HIGH','PERSIST_MED','PERSIST_LOW','SIG_SKYLINE','SIG_TELLURIC','NOT_ENOUGH_PSF','']
-        #   badflag = [1,1,1,1,1,1,1,1,
-        #              0,0,0,0,0,0,1,0]
-        mask = (np.bitwise_and(spec.bitmask,badval)!=0) | (np.isfinite(spec.flux)==False)
-        spec.mask = mask
-        # Extra masking for bright skylines
-        npix,nspec = flux.shape
-        x = np.arange(spec.npix)
-        nsky = 4
-        #for i in range(nspec):
-        #    medsky = median_filter(spec.sky[:,i],201,mode='reflect')
-        #    medcoef = dln.poly_fit(x,medsky/np.median(medsky),2)
-        #    medsky2 = dln.poly(x,medcoef)*np.median(medsky)
-        #    skymask1 = (sky>nsky*medsky2)    # pixels Nsig above median sky
-        #    spec.mask[:,i] = np.logical_or(spec.mask[:,i],skymask1)    # OR combine
-        # Fix NaN or bad pixels pixels
-        for i in range(nspec):
-            bd,nbd = dln.where( (np.isfinite(spec.flux[:,i])==False) | (spec.err[:,i] <= 0.0) )
-            if nbd>0:
-                spec.flux[bd,i] = 0.0
-                spec.err[bd,i] = 1e30
-                spec.mask[bd,i] = True
-        if nhdu>=9:
-            spec.meta = fits.getdata(filename,9)    # meta-data
+            # flux, err, sky, skyerr are in units of 1e-17
+            flux = hdulist[1].data.T * 1e-17
+            npix,nord = flux.shape
+            lsfcoef = hdulist[8].data.T
+            wave2 = np.tile(wave,nord).reshape(nord,npix).T   # make wave 2D
+            spec = Spec1D(flux,wave=wave2,lsfpars=lsfcoef,lsftype='Gauss-Hermite',lsfxtype='Pixels')
+            spec.filename = filename
+            spec.sptype = "apStar"
+            spec.waveregime = "NIR"
+            spec.instrument = "APOGEE"
+            spec.head = hdulist[0].header
+            spec.err = hdulist[2].data.T * 1e-17
+            #bad = (spec.err<=0)   # fix bad error values
+            #if np.sum(bad) > 0:
+            #    spec.err[bad] = 1e30
+            spec.bitmask = hdulist[3].data.T
+            spec.sky = hdulist[4].data.T * 1e-17
+            spec.skyerr = hdulist[5].data.T * 1e-17
+            spec.telluric = hdulist[6].data.T
+            spec.telerr = hdulist[7].data.T
+            spec.lsf = hdulist[8].data.T
+            # Create the bad pixel mask
+            # "bad" pixels:
+            #   flag = ['BADPIX','CRPIX','SATPIX','UNFIXABLE','BADDARK','BADFLAT','BADERR','NOSKY',
+            #           'LITTROW_GHOST','PERSIST_HIGH','PERSIST_MED','PERSIST_LOW','SIG_SKYLINE','SIG_TELLURIC','NOT_ENOUGH_PSF','']
+            #   badflag = [1,1,1,1,1,1,1,1,
+            #              0,0,0,0,0,0,1,0]
+            mask = (np.bitwise_and(spec.bitmask,badval)!=0) | (np.isfinite(spec.flux)==False)
+            spec.mask = mask
+            # Extra masking for bright skylines
+            npix,nspec = flux.shape
+            x = np.arange(spec.npix)
+            nsky = 4
+            #for i in range(nspec):
+            #    medsky = median_filter(spec.sky[:,i],201,mode='reflect')
+            #    medcoef = dln.poly_fit(x,medsky/np.median(medsky),2)
+            #    medsky2 = dln.poly(x,medcoef)*np.median(medsky)
+            #    skymask1 = (sky>nsky*medsky2)    # pixels Nsig above median sky
+            #    spec.mask[:,i] = np.logical_or(spec.mask[:,i],skymask1)    # OR combine
+            # Fix NaN or bad pixels pixels
+            for i in range(nspec):
+                bd,nbd = dln.where( (np.isfinite(spec.flux[:,i])==False) | (spec.err[:,i] <= 0.0) )
+                if nbd>0:
+                    spec.flux[bd,i] = 0.0
+                    spec.err[bd,i] = 1e30
+                    spec.mask[bd,i] = True
+            if nhdu>=9:
+                spec.meta = hdulist[9].data    # meta-data
         spec.snr = spec.head["SNR"]
         if base.find("apStar") > -1:
             spec.observatory = 'apo'
@@ -352,28 +350,24 @@ def boss(filename,badval=0):
         # HDU1 - binary table of spectral data
         # HDU2 - table with metadata including S/N
         # HDU3 - table with line measurements
-        head = fits.getheader(filename,0)
-        tab1 = Table.read(filename,1)
-        for c in tab1.colnames:   # Make column names all lowercase
-            tab1[c].name=c.lower()
-        cat1 = Table.read(filename,2)
+        with fits.open(filename) as hdulist:
+            head = hdulist[0].header
+            tab1 = Table.read(hdulist[1])
+            for c in tab1.colnames:   # Make column names all lowercase
+                tab1[c].name=c.lower()
+            cat1 = Table.read(hdulist[2])
         for c in cat1.colnames:   # Make column names all lowercase
             cat1[c].name=c.lower()
         flux = tab1["flux"].data
         wave = 10**tab1["loglam"].data
         wdisp = tab1["wdisp"].data
         # checking for zeros in IVAR
-        ivar = tab1["ivar"].data.copy()
-        bad = (ivar<=0)
-        if np.sum(bad) > 0:
-            ivar[bad] = 1.0
-            err = 1.0/np.sqrt(ivar)
-            err[bad] = 1e30  #np.nan
-            mask = np.zeros(flux.shape,bool)
-            mask[bad] = True
-        else:
-            err = 1.0/np.sqrt(ivar)
-            mask = np.zeros(flux.shape,bool)
+        ivar = tab1["ivar"].data
+        mask = (ivar<=0)
+        # err = 1/sqrt(ivar) computed in place, bad pixels are left at 1e30
+        err = np.full(ivar.shape,1e30,dtype=ivar.dtype.newbyteorder('='))
+        np.sqrt(ivar,out=err,where=~mask)
+        np.reciprocal(err,out=err,where=~mask)
         spec = Spec1D(flux,err=err,wave=wave,mask=mask,lsfsigma=wdisp,lsfxtype='Wave')
         spec.lsf.clean()   # clean up some bad LSF values
         spec.filename = filename
@@ -426,25 +420,20 @@ def mastar(filename,badval=0):
         # HDU1 - table with spectrum and metadata
         tab = Table.read(filename,1)
         flux = tab["FLUX"].data[0]
+        wave = tab["WAVE"].data[0]
         # checking for zeros in IVAR
-        ivar = tab["IVAR"].data[0].copy()
-        bad = (ivar<=0)
-        if np.sum(bad) > 0:
-            ivar[bad] = 1.0
-            err = 1.0/np.sqrt(ivar)
-            err[bad] = 1e30 #np.nan
-            mask = np.zeros(flux.shape,bool)
-            mask[bad] = True
-        else:
-            err = 1.0/np.sqrt(ivar)
-            mask = np.zeros(flux.shape,bool)
+        ivar = tab["IVAR"].data[0]
+        mask = (ivar<=0)
+        # err = 1/sqrt(ivar) computed in place, bad pixels are left at 1e30
+        err = np.full(ivar.shape,1e30,dtype=ivar.dtype.newbyteorder('='))
+        np.sqrt(ivar,out=err,where=~mask)
+        np.reciprocal(err,out=err,where=~mask)
         spec = Spec1D(flux,wave=wave,err=err,mask=mask)
         spec.filename = filename
         spec.sptype = "MaStar"
         spec.waveregime = "Optical"
         spec.instrument = "BOSS"        
         spec.ivar = tab["IVAR"].data[0]
-        spec.wave = tab["WAVE"].data[0]
         spec.bitmask = tab["MASK"].data[0]
         spec.disp = tab["DISP"].data[0]
         spec.presdisp = tab["PREDISP"].data[0]
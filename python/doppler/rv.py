@@ -10,8 +10,10 @@ __authors__ = 'David Nidever <dnidever@noao.edu>'
 __version__ = '20190622'  # yyyymmdd                                                                                                                           
 
 import os
+import math
 #import sys, traceback
-import contextlib, io, sys
+import contextlib, io, sys, functools
+import concurrent.futures
 import numpy as np
 import warnings
 from astropy.io import fits
@@ -20,9 +22,11 @@ import astropy.units as u
 from astropy.time import Time
 from astropy.coordinates import SkyCoord, EarthLocation
 from astropy.wcs import WCS
-from scipy.ndimage.filters import median_filter,gaussian_filter1d
+from scipy.ndimage.filters import median_filter
 from scipy.optimize import curve_fit, least_squares
+from scipy.signal import find_peaks
 from scipy.interpolate import interp1d
+from scipy import fft
 import thecannon as tc
 from dlnpyutils import utils as dln, bindata
 from .spec1d import Spec1D
@@ -43,9 +47,11 @@ warnings.filterwarnings("ignore", message="numpy.dtype size changed")
 warnings.filterwarnings("ignore", message="numpy.ufunc size changed")
 
 cspeed = 2.99792458e5  # speed of light in km/s
+LN10 = np.log(10.0)     # ln(10), for converting log10 wavelength steps
 
+@functools.lru_cache(maxsize=32)
 def xcorr_dtype(nlag):
-    """Return the dtype for the xcorr structure"""
+    """Return the dtype for the xcorr structure (cached for each nlag)"""
     dtype = np.dtype([("xshift0",float),("ccp0",float),("vrel0",float),("xshift",float),("xshifterr",float),
                       ("xshift_interp",float), ("ccf",(float,nlag)),("ccferr",(float,nlag)),("ccnlag",int),
                       ("cclag",(int,nlag)),("ccvlag",(float,nlag)),("ccpeak",float),("ccpfwhm",float),("ccp_pars",(float,4)),
@@ -53,6 +59,12 @@ def xcorr_dtype(nlag):
                       ("vrelerr",float),("w0",float),("dw",float),("chisq",float)])
     return dtype
 
+def xcorr_nlag(maxlag):
+    """Return the number of lags that specxcorr() uses for a [min,max] lag range"""
+    nlag = int(maxlag[1]-maxlag[0]+1)
+    if ((nlag % 2) == 0): nlag +=1  # make sure nlag is odd
+    return nlag
+
 # astropy.modeling can handle errors and constraints
 
 
@@ -91,18 +103,14 @@ def tweakcontinuum(spec,model):
     for i in range(spec.norder):
         smlen = spec.npix/10.0
         if spec.norder==1:
-            ratio = spec.flux/model.flux
-            mask = spec.mask
-            gd,ngd,bd,nbd = dln.where((mask==False) & (spec.flux>0) & np.isfinite(spec.flux),comp=True)            
+            flux,mflux,mask = spec.flux,model.flux,spec.mask
         else:
-            ratio = spec.flux[:,i]/model.flux[:,i]
-            mask = spec.mask[:,i]
-            gd,ngd,bd,nbd = dln.where((mask==False) & (spec.flux[:,i]>0) & np.isfinite(spec.flux[:,i]),comp=True)
+            flux,mflux,mask = spec.flux[:,i],model.flux[:,i],spec.mask[:,i]
         # Set bad pixels to NaN, gsmooth masks those out
-        if nbd>0:
-            ratio[bd] = np.nan
-        ratio[0] = np.nanmedian(ratio[0:np.int(smlen/2)])
-        ratio[-1] = np.nanmedian(ratio[-np.int(smlen/2):-1])
+        gd = (mask==False) & (flux>0) & np.isfinite(flux)
+        ratio = np.where(gd,flux/mflux,np.nan)
+        ratio[0] = np.nanmedian(ratio[0:int(smlen/2)])
+        ratio[-1] = np.nanmedian(ratio[-int(smlen/2):-1])
         sm = dln.gsmooth(ratio,smlen,boundary='extend')
         if spec.norder==1:
             spec.cont *= sm
@@ -186,6 +194,62 @@ def specfigure(figfile,spec,fmodel,out,original=None,verbose=True,figsize=10):
     if verbose is True: print('Figure saved to '+figfile)
 
 
+def lagsum(a, b, lag):
+    """Helper function to compute the lagged sum of products for multiple lags.
+
+    This computes sum(a[i]*b[i+lag]) for each lag, summing over the 1st dimension.
+    For many lags this is done with FFTs on zero-padded arrays which computes
+    all the lags at once.
+
+    Parameters
+    ----------
+    a : array
+      The first array, [Npix] or [Npix,Norder].
+    b : array
+      The second array.  Must have the same shape as a, or the two must
+        broadcast against each other in the 2nd dimension (e.g. [Npix,1]
+        and [Npix,Norder]).
+    lag : array
+      Array of integer lags.
+
+    Returns
+    -------
+    out : array
+      The lagged sums, [Nlag] or [Nlag,Norder].
+
+    Example
+    -------
+
+    .. code-block:: python
+
+         out = lagsum(a,b,lag)
+
+    """
+
+    n = a.shape[0]
+    lag = np.asarray(lag)
+    nlag = len(lag)
+    # Few lags, direct sums are faster
+    #  einsum does the (per-order) dot products without making temporary arrays
+    if nlag < 32:
+        # a[i] overlaps with b[i+lag] for i=lo to hi-1, for positive and negative lags
+        #  no overlap (empty slices) for lags at least as large as the array
+        lo = np.maximum(0,-lag)
+        hi = np.maximum(n-np.maximum(0,lag),lo)
+        out = np.zeros((nlag,)+np.broadcast_shapes(a.shape,b.shape)[1:],dtype=float)
+        for k in range(nlag):
+            out[k] = np.einsum('i...,i...->...',a[lo[k]:hi[k]],b[lo[k]+lag[k]:hi[k]+lag[k]])
+        return out
+    # Pad with zeros so the circular correlation does not wrap around
+    #  use a length that is fast for the FFTs, all orders are transformed at once
+    npad = fft.next_fast_len(n+np.max(np.abs(lag)),real=True)
+    fa = fft.rfft(a,n=npad,axis=0,workers=-1)
+    fb = fft.rfft(b,n=npad,axis=0,workers=-1)
+    full = fft.irfft(np.conj(fa)*fb,n=npad,axis=0,workers=-1)
+    # Negative lags are at the end
+    return full[lag % npad]
+
+
 def ccorrelate(x, y, lag, yerr=None, covariance=False, double=None, nomean=False):
     """This function computes the cross correlation of two samples.
 
@@ -290,189 +354,131 @@ def ccorrelate(x, y, lag, yerr=None, covariance=False, double=None, nomean=False
         raise ValueError("X and Y arrays must contain 2 or more elements.")
     
     # Reshape arrays to [Npix,Norder], even if both are 1D
-    xd = x.copy()
-    yd = y.copy()
-    if yerr is not None: yderr=yerr.copy()
-    if (norder>1):
-        if (x.ndim==1):
-            # make multiple copies of X
-            xd = yd.copy()*0.0
-            for i in range(norder):
-                xd[:,i] = x.copy()
-    else:
-        xd = xd.reshape(npix,1)
-        yd = yd.reshape(npix,1)        
-        if yerr is not None:
-            yderr = yderr.reshape(npix,1)
-        
-    # Remove the means
-    if nomean is False:
-        for i in range(norder):
-            xd[:,i] -= np.nanmean(xd[:,i])
-            yd[:,i] -= np.nanmean(yd[:,i])
-      
-    # Set NaNs or Infs to 0.0, mask bad pixels
+    #  these are views, the input arrays are not modified
+    xd = x.reshape(npix,-1)
+    yd = y.reshape(npix,-1)
+    if yerr is not None: yderr = yerr.reshape(npix,-1)
+
+    # Mask bad pixels, NaNs or Infs, and set them to 0.0
+    #  np.where makes the new arrays in one step
     fx = np.isfinite(xd)
-    ngdx = np.sum(fx)
-    nbdx = np.sum((fx==False))
-    if nbdx>0: xd[(fx==False)]=0.0
     fy = np.isfinite(yd)
+    xd = np.where(fx,xd,0.0)
+    yd = np.where(fy,yd,0.0)
+
+    # Remove the means of the finite pixels
+    #  reuse the masks and zeroed arrays instead of np.nanmean
+    if nomean is False:
+        xd -= fx*(np.sum(xd,axis=0)/np.maximum(np.sum(fx,axis=0),1))
+        yd -= fy*(np.sum(yd,axis=0)/np.maximum(np.sum(fy,axis=0),1))
+
     if yerr is not None:
         fy &= (yderr<1e20)   # mask out high errors as well
-    ngdy = np.sum(fy)
-    nbdy = np.sum((fy==False))
-    if nbdy>0:
-        yd[(fy==False)]=0.0
-        if yerr is not None: yderr[(fy==False)]=0.0
+        yd[~fy] = 0.0
+        yderr = np.where(fy,yderr,0.0)
     nlag = len(lag)
 
-    # MULTI-ORDER with ONE template and ONE spectrum to cross-correlate
-    ###################################################################
-    # This is 2.3x faster than the original method down below
-    #   for (4936, 3) spectra and nlag=765
-    if (norder>1) & (nxorder == nyorder):
+    # Initialize the output arrays
+    # All of the lags are computed at once for each order
+    #  if X is 1D then its single column is broadcast against all orders of Y
+    cross = lagsum(xd,yd,lag)
+    num = np.rint(lagsum(fx.astype(float),fy.astype(float),lag)).astype(int)  # number of "good" points at this lag
+    if yerr is not None:
+        cross_error = lagsum(xd**2,yderr**2,lag)
+        # FFT roundoff can leave tiny negative sums where nothing overlaps
+        np.maximum(cross_error,0,out=cross_error)
+    else:
+        cross_error = np.zeros((nlag,norder),dtype=float)
 
-        # Initialize the output arrays
-        cross = np.zeros(nlag,dtype=float)
-        cross_error = np.zeros(nlag,dtype=float)
-        num = np.zeros(nlag,dtype=int)  # number of "good" points at this lag        
-        
-        # flatten multi-order to 1D with buffer
-        buff = np.max(np.abs(lag))
-        xd1 = np.zeros(nx*norder + (norder-1)*buff,float)
-        yd1 = np.zeros(nx*norder + (norder-1)*buff,float)
-        yderr1 = np.zeros(nx*norder + (norder-1)*buff,float)
-        fx1 = np.zeros(nx*norder + (norder-1)*buff,bool)
-        fy1 = np.zeros(nx*norder + (norder-1)*buff,bool)    
-        for i in range(norder):
-            lo = i*(nx+buff)
-            hi = lo+nx
-            xd1[lo:hi] = xd[:,i]
-            yd1[lo:hi] = yd[:,i]
-            yderr1[lo:hi] = yderr[:,i]
-            fx1[lo:hi] = fx[:,i]
-            fy1[lo:hi] = fy[:,i]        
-        nx1 = len(xd1)
-            
-        # Loop over lag points
-        for k in range(nlag):
-            # Note the reversal of the variables for negative lags.
-            if lag[k]>0:
-                cross[k] = np.sum(xd1[0:nx1-lag[k]] * yd1[lag[k]:])
-                num[k] = np.sum(fx1[0:nx1-lag[k]] * fy1[lag[k]:]) 
-                if yerr is not None:
-                    cross_error[k] = np.sum( (xd1[0:nx1-lag[k]] * yderr1[lag[k]:])**2 )
-            else:
-                cross[k] =  np.sum(yd1[0:nx1+lag[k]] * xd1[-lag[k]:])
-                num[k] = np.sum(fy1[0:nx1+lag[k]] * fx1[-lag[k]:])
-                if yerr is not None:
-                    cross_error[k] = np.sum( (yderr1[0:nx1+lag[k]] * xd1[-lag[k]:])**2 )
-
-        rmsx = np.sqrt(np.sum((xd*fx)**2))
-        if rmsx==0.0: rmsx=1.0
-        rmsy = np.sqrt(np.sum((yd*fy)**2))
-        if rmsy==0.0: rmsy=1.0    
-
-        # Normalize by number of "good" points
-        cross *= np.max(num)
-        pnum = (num>0)
-        cross[pnum] /= num[pnum]  # normalize by number of "good" points
-        # Take sqrt to finish adding errors in quadrature
-        cross_error = np.sqrt(cross_error)
-        # normalize
-        cross_error *= np.max(num)
-        cross_error[pnum] /= num[pnum]
-
-        # Divide by N for covariance, or divide by variance for correlation.
+    # Sum of squares for each order, the bad pixels are already zero
+    if (npix>2):
+        rmsx = np.broadcast_to(np.sum(xd**2,axis=0),(norder,)).copy()
+        rmsy = np.sum(yd**2,axis=0)
+        rmsx[rmsx==0] = 1.0
+        rmsy[rmsy==0] = 1.0
+    else:
+        rmsx = np.ones(norder,dtype=float)
+        rmsy = np.ones(norder,dtype=float)
+
+    # Both X and Y are 2D, sum data from multiple orders
+    if (nxorder>1) & (nyorder>1):
+        cross = np.sum(cross,axis=1).reshape(nlag,1)
+        cross_error= np.sum(cross_error,axis=1).reshape(nlag,1)
+        num = np.sum(num,axis=1).reshape(nlag,1)
+        rmsx = np.sqrt(np.sum(rmsx,axis=0)).reshape(1)
+        rmsy = np.sqrt(np.sum(rmsy,axis=0)).reshape(1)
         nelements = npix*norder
-        if covariance is True:
-            cross /= nelements
-            cross_error /= nelements
-        else:
-            cross /= rmsx*rmsy
-            cross_error /= rmsx*rmsy
-
-        
-    # SIGLE-ORDER OR ONE template with MULTIPLE spectrum to cross-correlate
-    #######################################################################
+        norder = 1
     else:
-
-        # Initialize the output arrays
-        cross = np.zeros((nlag,norder),dtype=float)
-        cross_error = np.zeros((nlag,norder),dtype=float)
-        num = np.zeros((nlag,norder),dtype=int)  # number of "good" points at this lag        
-        rmsx = np.zeros(norder,dtype=float)
-        rmsy = np.zeros(norder,dtype=float)    
-    
-        # Loop over orders
-        for i in range(norder):
-            # Loop over lag points
-            for k in range(nlag):
-                # Note the reversal of the variables for negative lags.
-                if lag[k]>0:
-                    cross[k,i] = np.sum(xd[0:nx-lag[k],i] * yd[lag[k]:,i])
-                    num[k,i] = np.sum(fx[0:nx-lag[k],i] * fy[lag[k]:,i]) 
-                    if yerr is not None:
-                        cross_error[k,i] = np.sum( (xd[0:nx-lag[k],i] * yderr[lag[k]:,i])**2 )
-                else:
-                    cross[k,i] =  np.sum(yd[0:nx+lag[k],i] * xd[-lag[k]:,i])
-                    num[k,i] = np.sum(fy[0:nx+lag[k],i] * fx[-lag[k]:,i])
-                    if yerr is not None:
-                        cross_error[k,i] = np.sum( (yderr[0:nx+lag[k],i] * xd[-lag[k]:,i])**2 )
-                    
-            if (npix>2):
-                rmsx[i] = np.sum(xd[fx[:,i],i]**2)
-                if (rmsx[i]==0): rmsx[i]=1.0
-                rmsy[i] = np.sum(yd[fy[:,i],i]**2)
-                if (rmsy[i]==0): rmsy[i]=1.0
-            else:
-                rmsx[i] = 1.0
-                rmsy[i] = 1.0
-    
-        # Both X and Y are 2D, sum data from multiple orders
-        if (nxorder>1) & (nyorder>1):
-            cross = np.sum(cross,axis=1).reshape(nlag,1)
-            cross_error= np.sum(cross_error,axis=1).reshape(nlag,1)
-            num = np.sum(num,axis=1).reshape(nlag,1)
-            rmsx = np.sqrt(np.sum(rmsx,axis=0)).reshape(1)
-            rmsy = np.sqrt(np.sum(rmsy,axis=0)).reshape(1)
-            norder = 1
-            nelements = npix*norder
-        else:
-            rmsx = np.sqrt(rmsx)
-            rmsy = np.sqrt(rmsy)        
-            nelements = npix
+        rmsx = np.sqrt(rmsx)
+        rmsy = np.sqrt(rmsy)        
+        nelements = npix
   
-        # Normalizations
-        for i in range(norder):
-            # Normalize by number of "good" points
-            cross[:,i] *= np.max(num[:,i])
-            pnum = (num[:,i]>0)
-            cross[pnum,i] /= num[pnum,i]  # normalize by number of "good" points
-            # Take sqrt to finish adding errors in quadrature
-            cross_error[:,i] = np.sqrt(cross_error[:,i])
-            # normalize
-            cross_error[:,i] *= np.max(num[:,i])
-            cross_error[pnum,i] /= num[pnum,i]
-
-            # Divide by N for covariance, or divide by variance for correlation.
-            if covariance is True:
-                cross[:,i] /= nelements
-                cross_error[:,i] /= nelements
-            else:
-                cross[:,i] /= rmsx[i]*rmsy[i]
-                cross_error[:,i] /= rmsx[i]*rmsy[i]
+    # Normalizations, all orders at once
+    # Normalize by number of "good" points
+    #  lags without any good points are only scaled by the maximum
+    maxnum = np.max(num,axis=0)
+    numscale = np.where(num>0,maxnum/np.maximum(num,1),maxnum)
+    cross *= numscale
+    # Take sqrt to finish adding errors in quadrature, and normalize
+    cross_error = np.sqrt(cross_error)*numscale
+
+    # Divide by N for covariance, or divide by variance for correlation.
+    if covariance is True:
+        cross /= nelements
+        cross_error /= nelements
+    else:
+        cross /= rmsx*rmsy
+        cross_error /= rmsx*rmsy
 
-        # Flatten to 1D if norder=1
-        if norder==1:
-            cross = cross.flatten()
-            cross_error = cross_error.flatten()
-            
+    # Flatten to 1D if norder=1
+    if norder==1:
+        cross = cross.flatten()
+        cross_error = cross_error.flatten()
+        
     if yerr is not None: return cross, cross_error
     return cross
 
 
-def specxcorr(wave=None,tempspec=None,obsspec=None,obserr=None,maxlag=[-200,200],gfilt=0,errccf=False,prior=None,plot=False):
+def specxcorr_perror(x,y,yerr,pars):
+    """
+    Helper function for specxcorr() that computes the uncertainties of the
+    Gaussian fit to the CCF peak.
+
+    The fit uses a robust loss which only changes the best-fit parameters.
+    The uncertainties come from the usual (non-robust) least-squares
+    covariance at those parameters, scaled by the reduced chi-squared.
+
+    Parameters
+    ----------
+    x : array
+       The lags of the fitted CCF points.
+    y : array
+       The CCF values.
+    yerr : array
+       The CCF uncertainties.
+    pars : array
+       The best-fit Gaussian parameters [amp,cen,sig,const].
+
+    Returns
+    -------
+    perror : array
+       The uncertainties of the parameters.
+
+    Examples
+    --------
+    perror = specxcorr_perror(lag,ccf,ccferr,pars)
+
+    """
+    jac = utils.gaussian_jac(x,*pars)/yerr.reshape(-1,1)
+    resid = (y-utils.gaussian(x,*pars))/yerr
+    dof = np.maximum(len(x)-len(pars),1)
+    cov = np.linalg.pinv(jac.T @ jac)*np.sum(resid**2)/dof
+    return np.sqrt(np.abs(np.diag(cov)))
+
+
+def specxcorr(wave=None,tempspec=None,obsspec=None,obserr=None,maxlag=[-200,200],gfilt=0,errccf=False,prior=None,plot=False,
+              obsprep=None,out=None):
     """This measures the radial velocity of a spectrum vs. a template using cross-correlation.
 
     This program measures the cross-correlation shift between
@@ -492,10 +498,22 @@ def specxcorr(wave=None,tempspec=None,obsspec=None,obserr=None,maxlag=[-200,200]
            The observed error; normalized and sampled on tempspec scale.
     maxlag : int
            The maximum lag or shift to explore.
+    gfilt : int, optional
+           Remove a smooth (quadratic) background from the CCF before
+             fitting the peak if gfilt>0.  The default is 0.
     prior : array, optional 
            Set a Gaussian prior on the cross-correlation.  The first
            term is the central position (in pixel shift) and the
            second term is the Gaussian sigma (in pixels).
+    obsprep : tuple, optional
+           The masked observed spectrum and smoothed error array output by
+             specxcorr_prep() for obsspec and obserr.  Use this to avoid
+             redoing that work when the same observed spectrum is
+             cross-correlated with many templates.
+    out : numpy structured array, optional
+           A one-element array with dtype xcorr_dtype(xcorr_nlag(maxlag)) to
+             write the output into, e.g. a slice of a larger preallocated
+             array.  By default a new array is created.
 
     Returns
     -------
@@ -528,34 +546,37 @@ def specxcorr(wave=None,tempspec=None,obsspec=None,obserr=None,maxlag=[-200,200]
     # Set up the cross-correlation parameters
     #  this only gives +/-450 km/s with 2048 pixels, maybe use larger range
     #nlag = 2*np.round(np.abs(maxlag))+1
-    nlag=maxlag[1]-maxlag[0]+1
-    if ((nlag % 2) == 0): nlag +=1  # make sure nlag is odd
+    nlag = xcorr_nlag(maxlag)
     dlag = 1
     #minlag = -np.int(np.ceil(nlag/2))
     minlag=maxlag[0]
     lag = np.arange(nlag)*dlag+minlag+1
 
     # Initialize the output structure
-    outstr = np.zeros(1,dtype=xcorr_dtype(nlag))
+    if out is None:
+        outstr = np.zeros(1,dtype=xcorr_dtype(nlag))
+    else:
+        if out.dtype != xcorr_dtype(nlag):
+            raise ValueError("out must have dtype xcorr_dtype("+str(nlag)+")")
+        outstr = out
+        outstr[...] = 0
     outstr["xshift"] = np.nan
     outstr["xshifterr"] = np.nan
     outstr["vrel"] = np.nan
     outstr["vrelerr"] = np.nan
     outstr["chisq"] = np.nan
 
-    wobs = wave.copy()
+    # wave and err are only read, no need to copy them
+    wobs = wave
     nw = len(wobs)
-    spec = obsspec.copy()
-    err = obserr.copy()
-    template = tempspec.copy()
+    err = obserr
 
     # mask bad pixels, set to NAN
-    sfix = (spec < 0.01)
-    nsfix = np.sum(sfix)
-    if nsfix>0: spec[sfix] = np.nan
-    tfix = (template < 0.01)
-    ntfix = np.sum(tfix)
-    if ntfix>0: template[tfix] = np.nan
+    #  the observed spectrum part only needs to be done once
+    if obsprep is None:
+        obsprep = specxcorr_prep(obsspec,obserr)
+    spec, obserr1 = obsprep
+    template = np.where(tempspec < 0.01, np.nan, tempspec)
     
     # set cross-corrlation window to be good range + nlag
     #lo = (0 if (gd[0]-nlag)<0 else gd[0]-nlag)
@@ -566,26 +587,6 @@ def specxcorr(wave=None,tempspec=None,obsspec=None,obserr=None,maxlag=[-200,200]
     if (nindobs>0) & (nindtemp>0):
         # Cross-Correlation
         #------------------
-        # Calculate the CCF uncertainties using propagation of errors
-        # Make median filtered error array
-        #   high error values give crazy values in ccferr
-        obserr1 = err.copy()
-        if err.ndim==1:
-            bderr = ((obserr1 > 1) | (obserr1 <= 0.0))
-            nbderr = np.sum(bderr)
-            ngderr = np.sum((bderr==False))
-            if (nbderr > 0) & (ngderr > 1): obserr1[bderr]=np.median([obserr1[(bderr==False)]])
-            obserr1 = median_filter(obserr1,51)
-        if err.ndim==2:
-            for i in range(obserr1.shape[1]):
-                oerr1 = obserr1[:,i]
-                bderr = ((oerr1 > 1) | (oerr1 <= 0.0))
-                nbderr = np.sum(bderr)
-                ngderr = np.sum((bderr==False))
-                if (nbderr > 0) & (ngderr > 1): oerr1[bderr]=np.median([oerr1[(bderr==False)]])
-                oerr1 = median_filter(oerr1,51)
-                obserr1[:,i] = oerr1
-
         # Run the cross-correlation
         ccf, ccferr = ccorrelate(template,spec,lag,obserr1)
         
@@ -605,8 +606,13 @@ def specxcorr(wave=None,tempspec=None,obsspec=None,obserr=None,maxlag=[-200,200]
     # Best shift
     best_shiftind0 = np.argmax(ccf)
     best_xshift0 = lag[best_shiftind0]
-    #temp = shift( tout, best_xshift0)
-    temp = np.roll(template, best_xshift0, axis=0)
+    # Shift the template, pixels shifted in from the edge are NaN
+    #  and drop out of the chisq instead of wrapping around
+    temp = np.full(template.shape,np.nan)
+    if best_xshift0>=0:
+        temp[best_xshift0:] = template[0:np.maximum(nw-best_xshift0,0)]
+    else:
+        temp[0:best_xshift0] = template[-best_xshift0:]
 
     # Find Chisq for each synthetic spectrum
     gdmask = (np.isfinite(spec)==True) & (np.isfinite(temp)==True) & (spec>0.0) & (err>0.0) & (err < 1e5)
@@ -636,76 +642,64 @@ def specxcorr(wave=None,tempspec=None,obsspec=None,obserr=None,maxlag=[-200,200]
     outstr["cclag"] = lag    
     
     # Remove smooth background at large scales
+    #  a quadratic is all that a CCF this short can support
     if gfilt > 0 :
-        cont = gaussian_filter1d(ccf,filter)
+        cont = utils.poly(lag,np.polynomial.polynomial.polyfit(lag,ccf,2))
         ccf_diff = ccf-cont
     else : ccf_diff = ccf
 
     # Get peak of CCF
-    best_shiftind = np.argmax(ccf_diff)
+    #  use the most prominent peak, find_peaks also measures its width
+    #  at half of the prominence which is the initial Gaussian width
+    #  Some CCF peaks are SOOO wide that they span the whole width
+    peaks, props = find_peaks(ccf_diff,prominence=0.05*np.ptp(ccf_diff),width=0)
+    if len(peaks)>0:
+        ipeak = np.argmax(props['prominences'])
+        best_shiftind = peaks[ipeak]
+        sig0 = np.maximum(props['widths'][ipeak]*dlag/2.35482,0.5)
+    else:
+        best_shiftind = np.argmax(ccf_diff)
+        sig0 = 4.0
     best_xshift = lag[best_shiftind]
     
-    # Fit ccf peak with a Gaussian plus a line
+    # Fit ccf peak with a Gaussian plus a constant
     #---------------------------------------------
-    # Some CCF peaks are SOOO wide that they span the whole width
-    # do the first one without background subtraction
-    estimates0 = [ccf_diff[best_shiftind0], best_xshift0, 4.0, 0.0]
-    lbounds0 = [1e-6, np.min(lag), 0.1, -np.inf]
-    ubounds0 =  [np.inf, np.max(lag), np.max(lag)-np.min(lag), np.inf]
-    pars0, cov0 = dln.gaussfit(lag,ccf_diff,estimates0,ccferr,bounds=(lbounds0,ubounds0))
-    perror0 = np.sqrt(np.diag(cov0))
-
-    # Fit the width
-    #  keep height, center and constant constrained
-    estimates1 = pars0
-    estimates1[1] = best_xshift
-    lbounds1 = [0.5*estimates1[0], best_xshift-4, 0.3*estimates1[2], dln.lt(np.min(ccf_diff),dln.lt(0,estimates1[3]-0.1)) ]
-    ubounds1 =  [1.5*estimates1[0], best_xshift+4, 1.5*estimates1[2], dln.gt(np.max(ccf_diff)*0.5,estimates1[3]+0.1) ]
-    lo1 = np.int(dln.gt(np.floor(best_shiftind-dln.gt(estimates1[2]*2,5)),0))
-    hi1 = np.int(dln.lt(np.ceil(best_shiftind+dln.gt(estimates1[2]*2,5)),len(lag)))
-    pars1, cov1 = dln.gaussfit(lag[lo1:hi1],ccf_diff[lo1:hi1],estimates1,ccferr[lo1:hi1],bounds=(lbounds1,ubounds1))
-    yfit1 = dln.gaussian(lag[lo1:hi1],*pars1)
-    perror1 = np.sqrt(np.diag(cov1))
-    
-    # Refit and let constant vary more, keep width constrained
-    estimates2 = pars1
-    estimates2[1] = dln.limit(estimates2[1],np.min(lag),np.max(lag))    # must be in range
-    estimates2[3] = np.median(ccf_diff[lo1:hi1]-yfit1) + pars1[3]
-    lbounds2 = [0.5*estimates2[0], dln.limit(best_xshift-dln.gt(estimates2[2],1), np.min(lag), estimates2[1]-1),
-                0.3*estimates2[2], dln.lt(np.min(ccf_diff),dln.lt(0,estimates2[3]-0.1)) ]
-    ubounds2 = [1.5*estimates2[0], dln.limit(best_xshift+dln.gt(estimates2[2],1), estimates2[1]+1, np.max(lag)),
-                1.5*estimates2[2], dln.gt(np.max(ccf_diff)*0.5,estimates2[3]+0.1) ]
-    lo2 = np.int(dln.gt(np.floor( best_shiftind-dln.gt(estimates2[2]*2,5)),0))
-    hi2 = np.int(dln.lt(np.ceil( best_shiftind+dln.gt(estimates2[2]*2,5)),len(lag)))
-    pars2, cov2 = dln.gaussfit(lag[lo2:hi2],ccf_diff[lo2:hi2],estimates2,ccferr[lo2:hi2],bounds=(lbounds2,ubounds2))
-    yfit2 = dln.gaussian(lag[lo2:hi2],*pars2)    
-    perror2 = np.sqrt(np.diag(cov2))
-    
-    # Refit with even narrower range
-    estimates3 = pars2
-    estimates3[1] = dln.limit(estimates3[1],np.min(lag),np.max(lag))    # must be in range
-    estimates3[3] = np.median(ccf_diff[lo1:hi1]-yfit1) + pars1[3]
-    lbounds3 = [0.5*estimates3[0], dln.limit(best_xshift-dln.gt(estimates3[2],1), np.min(lag), estimates3[1]-1),
-                0.3*estimates3[2], dln.lt(np.min(ccf_diff),dln.lt(0,estimates3[3]-0.1)) ]
-    ubounds3 = [1.5*estimates3[0], dln.limit(best_xshift+dln.gt(estimates3[2],1), estimates3[1]+1, np.max(lag)),
-                1.5*estimates3[2], dln.gt(np.max(ccf_diff)*0.5,estimates3[3]+0.1) ]    
-    lo3 = np.int(dln.gt(np.floor(best_shiftind-dln.gt(estimates3[2]*2,5)),0))
-    hi3 = np.int(dln.lt(np.ceil(best_shiftind+dln.gt(estimates3[2]*2,5)),len(lag)))
-    pars3, cov3 = dln.gaussfit(lag[lo3:hi3],ccf_diff[lo3:hi3],estimates3,ccferr[lo3:hi3],bounds=(lbounds3,ubounds3))
-    yfit3 = dln.gaussian(lag[lo3:hi3],*pars3)    
-    perror3 = np.sqrt(np.diag(cov3))
+    # Only fit the peak region.  A robust loss function keeps the
+    #  structure in the wings from pulling the fit.
+    #  the peak region is +/-2 sigma
+    peakwindow = lambda sig: (int(np.maximum(best_shiftind-np.ceil(np.maximum(sig*2,5)),0)),
+                              int(np.minimum(best_shiftind+np.ceil(np.maximum(sig*2,5)),nlag)))
+    amp0 = np.maximum(ccf_diff[best_shiftind],1e-6)
+    lo,hi = peakwindow(sig0)
+    estimates = [amp0, best_xshift, sig0, 0.0]
+    lbounds = [0.5*amp0, np.clip(best_xshift-np.maximum(sig0,1), np.min(lag), best_xshift-1),
+               0.3*sig0, np.min(ccf_diff)-amp0]
+    ubounds = [1.5*amp0, np.clip(best_xshift+np.maximum(sig0,1), best_xshift+1, np.max(lag)),
+               1.5*sig0, np.maximum(np.max(ccf_diff)*0.5,0.1)]
+    # Residuals larger than the scatter of the CCF away from the peak are downweighted
+    wings = np.ones(nlag,bool)
+    wings[lo:hi] = False
+    f_scale = dln.mad(ccf_diff[wings]/ccferr[wings]) if np.sum(wings)>5 else np.nan
+    if (np.isfinite(f_scale)==False) | (f_scale<=0): f_scale=1.0
+    pars, cov = utils.gaussfit(lag[lo:hi],ccf_diff[lo:hi],estimates,ccferr[lo:hi],bounds=(lbounds,ubounds),
+                               loss='soft_l1',f_scale=f_scale)
+    # Refit over the window given by the fitted width, if it changed
+    if peakwindow(pars[2]) != (lo,hi):
+        lo,hi = peakwindow(pars[2])
+        pars, cov = utils.gaussfit(lag[lo:hi],ccf_diff[lo:hi],pars,ccferr[lo:hi],bounds=(lbounds,ubounds),
+                                   loss='soft_l1',f_scale=f_scale)
+    perror = specxcorr_perror(lag[lo:hi],ccf_diff[lo:hi],ccferr[lo:hi],pars)
 
     # This seems to fix high shift/sigma errors
-    if (perror3[0]>10) | (perror3[1]>10):
-        dlbounds3 = [0.5*estimates3[0], -10+pars3[1], 0.01, dln.lt(np.min(ccf_diff),dln.lt(0,estimates3[3]-0.1)) ]
-        dubounds3 = [1.5*estimates3[0], 10+pars3[1], 2*pars3[2], dln.gt(np.max(ccf_diff)*0.5,estimates3[3]+0.1) ]
-        dpars3, dcov3 = dln.gaussfit(lag[lo3:hi3],ccf_diff[lo3:hi3],pars3,ccferr[lo3:hi3],bounds=(dlbounds3,dubounds3))
-        dyfit3 = dln.gaussian(lag[lo3:hi3],*pars3)    
-        perror3 = np.sqrt(np.diag(dcov3))
+    if (perror[0]>10) | (perror[1]>10):
+        dlbounds = [0.5*pars[0], -10+pars[1], 0.01, np.minimum(np.min(ccf_diff),np.minimum(0,pars[3]-0.1)) ]
+        dubounds = [1.5*pars[0], 10+pars[1], 2*pars[2], np.maximum(np.max(ccf_diff)*0.5,pars[3]+0.1) ]
+        pars, cov = utils.gaussfit(lag[lo:hi],ccf_diff[lo:hi],pars,ccferr[lo:hi],bounds=(dlbounds,dubounds),
+                                   loss='soft_l1',f_scale=f_scale)
+        perror = specxcorr_perror(lag[lo:hi],ccf_diff[lo:hi],ccferr[lo:hi],pars)
+    yfit = utils.gaussian(lag[lo:hi],*pars)
 
     # Final parameters
-    pars = pars3
-    perror = perror3
     xshift = pars[1]
     xshifterr = perror[1]
     ccpfwhm_pix = pars[2]*2.35482  # ccp fwhm in pixels
@@ -718,16 +712,16 @@ def specxcorr(wave=None,tempspec=None,obsspec=None,obserr=None,maxlag=[-200,200]
     # delta log(wave) = log(v/c+1)
     # v = (10^(delta log(wave))-1)*c
     #  why not v = delta ln(wave) * c?
-    dwlog = np.median(dln.slope(np.log10(wave)))
     vrel = ( 10**(xshift*dwlog)-1 )*cspeed
     # Vrel uncertainty
-    dvreldshift = np.log(10.0)*(10**(xshift*dwlog))*dwlog*cspeed  # derivative wrt shift
+    #  derivative wrt shift, 10**(xshift*dwlog) = 1+vrel/c
+    dvreldshift = LN10*(1+vrel/cspeed)*dwlog*cspeed
     vrelerr = dvreldshift * xshifterr
     
     # Make CCF structure and add to STR
     #------------------------------------
     outstr["xshift0"] = best_xshift
-    outstr["vrel0"] = best_xshift*dwlog*np.log(10)*cspeed
+    outstr["vrel0"] = best_xshift*dwlog*LN10*cspeed
     outstr["ccp0"] = np.max(ccf)
     outstr["xshift"] = xshift
     outstr["xshifterr"] = xshifterr
@@ -742,19 +736,68 @@ def specxcorr(wave=None,tempspec=None,obsspec=None,obserr=None,maxlag=[-200,200]
     outstr["w0"] = np.min(wave)
     outstr["dw"] = dwlog
 
-    tmp = np.median(dln.slope(np.log(wave)))*cspeed
     if plot :
+        tmp = dwlog*LN10*cspeed   # velocity per pixel
         ax[1].plot(lag*tmp,ccf)
         ax[1].plot(lag*tmp,ccf_diff)
-        ax[1].plot(lag[lo3:hi3]*tmp,yfit3)
+        ax[1].plot(lag[lo:hi]*tmp,yfit)
         plt.draw()
         
     
     return outstr
 
 
+def specxcorr_prep(obsspec,obserr):
+    """
+    Helper function for specxcorr() that prepares the observed spectrum.
+
+    Bad pixels (<0.01) in the spectrum are set to NaN and a median filtered
+    error array is made for the CCF uncertainties.  This only depends on the
+    observed spectrum so it can be reused for many templates.
+
+    Parameters
+    ----------
+    obsspec : array
+           The observed spectra: normalized and sampled on tempspec scale.
+    obserr : array
+           The observed error; normalized and sampled on tempspec scale.
+
+    Returns
+    -------
+    spec : array
+         The observed spectrum with bad pixels set to NaN.
+    obserr1 : array
+         The median filtered error array.
+
+    Examples
+    --------
+
+    obsprep = specxcorr_prep(obs.flux,obs.err)
+
+    """
+
+    # mask bad pixels, set to NAN
+    spec = np.where(obsspec < 0.01, np.nan, obsspec)
+
+    # Calculate the CCF uncertainties using propagation of errors
+    # Make median filtered error array
+    #   high error values give crazy values in ccferr
+    #   all orders are done at once, [Npix,Norder]
+    oerr = obserr.reshape(len(obserr),-1)
+    bderr = ((oerr > 1) | (oerr <= 0.0))
+    ngderr = np.sum(~bderr,axis=0)
+    # replace bad values with the median of the good ones in each order
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore',category=RuntimeWarning)   # all-bad orders
+        mederr = np.nanmedian(np.where(bderr,np.nan,oerr),axis=0)
+    obserr1 = np.where(bderr & (ngderr>1), mederr, oerr)
+    obserr1 = median_filter(obserr1,size=(51,1)).reshape(obserr.shape)
+
+    return spec, obserr1
+
+
 def normspec(spec=None,ncorder=6,fixbadpix=True,noerrcorr=False,
-             binsize=0.05,perclevel=95.0,growsky=False,nsky=5):
+             binsize=0.05,perclevel=95.0,growsky=False,nsky=5,nproc=1):
     """
     This program normalizes a spectrum.
 
@@ -777,6 +820,9 @@ def normspec(spec=None,ncorder=6,fixbadpix=True,noerrcorr=False,
 
     perclevel : float, default=95
             The Nth percentile to use to determine the continuum.
+    nproc : int, default=1
+            Number of processes to use for 2D spectra.  Each spectrum
+            is normalized independently.  The default is to run serially.
 
     Returns
     -------
@@ -798,143 +844,156 @@ def normspec(spec=None,ncorder=6,fixbadpix=True,noerrcorr=False,
     if spec is None:
         raise ValueError("""spec2 = normspec(spec,fixbadpix=fixbadpix,ncorder=ncorder,noerrcorr=noerrcorr,
                                              binsize=binsize,perclevel=perclevel)""")
-    musthave = ['flux','err','mask','wave']
-    for a in musthave:
-        if hasattr(spec,a) is False:
-            raise ValueError("spec object must have "+a)
+    # err and mask are optional
+    flux = getattr(spec,'flux',None)
+    w = getattr(spec,'wave',None)
+    if flux is None: raise ValueError("spec object must have flux")
+    if w is None: raise ValueError("spec object must have wave")
+    yerr = getattr(spec,'err',None)
+    mask = getattr(spec,'mask',None)
 
     # Can only do 1D or 2D arrays
-    if spec.flux.ndim>2:
+    if flux.ndim>2:
         raise RuntimeError("Flux can only be 1D or 2D arrays")
-        
-    # Do special processing if the input is 2D
-    #  Loop over the shorter axis
-    if spec.flux.ndim==2:
-        nx, ny = spec.flux.shape
-        nspec = np.zeros(spec.flux.shape)
-        cont = np.zeros(spec.flux.shape)
-        masked = np.zeros(spec.flux.shape,bool)
-        if nx<ny:
-            for i in range(nx):
-                flux = spec.flux[i,:]
-                err = spec.err[i,:]
-                mask = spec.mask[i,:]
-                wave = spec.wave[i,:]
-                spec1 = Spec1D(flux)
-                spec1.err = err
-                spec1.mask = mask
-                spec1.wave = wave
-                nspec1, cont1, masked1 = normspec(spec1,fixbadpix=fixbadpix,ncorder=ncorder,noerrcorr=noerrcorr,
-                                                  binsize=binsize,perclevel=perclevel)
-                nspec[i,:] = nspec1
-                cont[i,:] = cont1
-                masked[i,:] = masked1                
-        else:
-            for i in range(ny):
-                flux = spec.flux[:,i]
-                err = spec.err[:,i]
-                mask = spec.mask[:,i]
-                wave = spec.wave[:,i]
-                spec1 = Spec1D(flux)
-                spec1.err = err
-                spec1.mask = mask
-                spec1.wave = wave
-                nspec1, cont1, masked1 = normspec(spec1,fixbadpix=fixbadpix,ncorder=ncorder,noerrcorr=noerrcorr,
-                                                  binsize=binsize,perclevel=perclevel)
-                nspec[:,i] = nspec1
-                cont[:,i] = cont1
-                masked[:,i] = masked1                
-        return (nspec,cont,masked)
-                
-        
+
+    # Put the arrays in [Npix,Nspec] form
+    #  for 2D input each spectrum runs along the longer (pixel) axis
+    shape = flux.shape
+    y = flux
+    transpose = (flux.ndim==2) and (shape[0]<shape[1])
+    if transpose:
+        w,y = w.T,y.T
+        if yerr is not None: yerr = yerr.T
+        if mask is not None: mask = mask.T
+    npix = y.shape[0]
+    w = w.reshape(npix,-1)
+    y = y.reshape(npix,-1)
+    if yerr is not None: yerr = yerr.reshape(npix,-1)
+    if mask is not None: mask = mask.reshape(npix,-1)
+    ncol = y.shape[1]
+
     # Continuum Normalize
     #----------------------
-    w = spec.wave.copy()
-    x = (w-np.median(w))/(np.max(w*0.5)-np.min(w*0.5))  # -1 to +1
-    y = spec.flux.copy()
-    yerr = None
-    if hasattr(spec,'err') is True:
-        if spec.err is not None:
-            yerr = spec.err.copy()
-            
+    x = (w-np.median(w,axis=0))/(0.5*(np.max(w,axis=0)-np.min(w,axis=0)))  # -1 to +1
+
     # Get good pixels, and set bad pixels to NAN
     #--------------------------------------------
-    gdmask = (y>0)        # need positive fluxes
-    ytemp = y.copy()
-
-    # Exclude pixels with mask=bad
-    if hasattr(spec,'mask') is True:
-        if spec.mask is not None:
-            mask = spec.mask.copy()
-            gdmask = (mask == 0)
-    gdpix = (gdmask == 1)
-    ngdpix = np.sum(gdpix)
-    bdpix = (gdmask != 1)
-    nbdpix = np.sum(bdpix)
-    if nbdpix>0: ytemp[bdpix]=np.nan   # set bad pixels to NAN for now
+    if mask is not None:
+        gdmask = (mask == 0)   # exclude pixels with mask=bad
+    else:
+        gdmask = (y>0)         # need positive fluxes
+    bdpix = ~gdmask
+    ytemp = np.where(bdpix,np.nan,y)   # set bad pixels to NAN for now
+
+    # Loop over the spectra
+    cont = np.zeros((npix,ncol),float)
+    yerrlist = [None]*ncol if yerr is None else list(yerr.T)
+    kwargs = {'ncorder':ncorder,'noerrcorr':noerrcorr,'binsize':binsize,'perclevel':perclevel}
+    if (nproc>1) & (ncol>1):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(nproc,ncol)) as executor:
+            futures = [executor.submit(normspec_cont,x[:,i],ytemp[:,i],yerrlist[i],**kwargs) for i in range(ncol)]
+            for i,f in enumerate(futures):
+                cont[:,i] = f.result()
+    else:
+        for i in range(ncol):
+            cont[:,i] = normspec_cont(x[:,i],ytemp[:,i],yerrlist[i],**kwargs)
+
+    # Create continuum normalized spectrum
+    nspec = y/cont
+
+    # Add "masked" array
+    masked = np.zeros((npix,ncol),bool)
+    if fixbadpix is True:
+        masked[bdpix] = True
+
+    # Back to the input shape
+    if transpose:
+        nspec,cont,masked = nspec.T,cont.T,masked.T
+    nspec = nspec.reshape(shape)
+    cont = cont.reshape(shape)
+    masked = masked.reshape(shape)
+
+    return (nspec,cont,masked)
+
+
+def normspec_cont(x,y,yerr=None,ncorder=6,noerrcorr=False,binsize=0.05,perclevel=95.0):
+    """
+    Helper function for normspec() that measures the continuum of a single spectrum.
+
+    Parameters
+    ----------
+    x : array
+      The normalized (-1 to +1) wavelength array.
+    y : array
+      The flux array with bad pixels set to NaN.
+    yerr : array, optional
+      The flux uncertainty array.
+    ncorder : int, default=6
+      The continuum polynomial order.
+    noerrcorr : bool, default=False
+      Do not use a correction for the effects of the errors
+      on the continuum measurement.
+    binsize : float, default=0.05
+      The binsize to use for determining the Nth percentile spectrum.
+    perclevel : float, default=95
+      The Nth percentile to use to determine the continuum.
+
+    Returns
+    -------
+    cont : array
+      The continuum array.
+
+    Examples
+    --------
+
+    cont = normspec_cont(x,y,yerr)
+
+    """
 
     # First attempt at continuum
     #----------------------------
     # Bin the data points
     xr = [np.nanmin(x),np.nanmax(x)]
     bins = np.ceil((xr[1]-xr[0])/binsize)+1
-    ybin, bin_edges, binnumber = bindata.binned_statistic(x,ytemp,statistic='percentile',
-                                                          percentile=perclevel,bins=bins,range=None)
+    ybin, bin_edges, binnumber = utils.binned_percentile(x,y,bins,percentile=perclevel)
     xbin = bin_edges[0:-1]+0.5*binsize
     gdbin = np.isfinite(ybin)
     ngdbin = np.sum(gdbin)
     if ngdbin<(ncorder+1):
         raise RuntimeError("Not enough good flux points to fit the continuum")
     # Fit with robust polynomial
-    coef1 = dln.poly_fit(xbin[gdbin],ybin[gdbin],ncorder,robust=True)
-    cont1 = dln.poly(x,coef1)
+    coef1 = utils.poly_fit(xbin[gdbin],ybin[gdbin],ncorder,robust=True)
+    cont1 = utils.poly(x,coef1)
 
-    # Subtract smoothed error from it to remove the effects
+    # Subtract the median error from it to remove the effects
     #  of noise on the continuum measurement
     if (yerr is not None) & (noerrcorr is False):
-        smyerr = dln.medfilt(yerr,151)                            # first median filter
-        smyerr = dln.gsmooth(smyerr,100)                          # Gaussian smoothing
-        coef_err = dln.poly_fit(x,smyerr,ncorder,robust=True)     # fit with robust poly
-        #poly_err = dln.poly(x,coef_err)
-        #cont1 -= 2*dln.poly_err   # is this right????
-        med_yerr = np.median(smyerr)                          # median error
+        gderr = np.isfinite(yerr) & (yerr>0)
+        med_yerr = np.median(yerr[gderr]) if np.sum(gderr)>0 else 0.0   # median error
         cont1 -= 2*med_yerr
 
     # Second iteration
     #-----------------
     #  This helps remove some residual structure
-    ytemp2 = ytemp/cont1
-    ybin2, bin_edges2, binnumber2 = bindata.binned_statistic(x,ytemp2,statistic='percentile',
-                                                             percentile=perclevel,bins=bins,range=None)
+    ytemp2 = y/cont1
+    #  x is unchanged so the bin numbers can be reused
+    ybin2, bin_edges2, binnumber2 = utils.binned_percentile(x,ytemp2,bins,percentile=perclevel,
+                                                            binnumber=binnumber)
     xbin2 = bin_edges2[0:-1]+0.5*binsize
     gdbin2 = np.isfinite(ybin2)
     ngdbin2 = np.sum(gdbin2)
     if ngdbin2<(ncorder+1):
         raise RuntimeError("Not enough good flux points to fit the continuum")
     # Fit with robust polynomial
-    coef2 = dln.poly_fit(xbin2[gdbin2],ybin2[gdbin2],ncorder,robust=True)
-    cont2 = dln.poly(x,coef2)
+    coef2 = utils.poly_fit(xbin2[gdbin2],ybin2[gdbin2],ncorder,robust=True)
+    cont2 = utils.poly(x,coef2)
 
     # Subtract smoothed error again
     if (yerr is not None) & (noerrcorr is False):    
       cont2 -= med_yerr/cont1
 
     # Final continuum
-    cont = cont1*cont2  # final continuum
-
-    # "Fix" bad pixels
-    if (nbdpix>0) & fixbadpix is True:
-        y[bdpix] = cont[bdpix]
-
-    # Create continuum normalized spectrum
-    nspec = spec.flux.copy()/cont
-
-    # Add "masked" array
-    masked = np.zeros(spec.flux.shape,bool)
-    if (fixbadpix is True) & (nbdpix>0):
-        masked[bdpix] = True
-    
-    return (nspec,cont,masked)
+    return cont1*cont2
 
 
 def spec_resid(pars,wave,flux,err,models,spec):
@@ -1169,12 +1228,16 @@ def fit_xcorrgrid(spec,models=None,samples=None,verbose=False,maxvel=[-1000.,100
                          ('ccpfwhm',np.float32),('vrel0',np.float32),
                          ('chisq',np.float32),('teff',np.float32),('logg',np.float32),('feh',np.float32)])
     outstr = np.zeros(len(teff),dtype=outdtype)
+    # The observed spectrum is the same for all of the models
+    obsprep = specxcorr_prep(obs.flux,obs.err)
+    xcorrstr = np.zeros(len(samples),dtype=xcorr_dtype(xcorr_nlag(maxlag)))
     if verbose is True: logger.info('TEFF    LOGG     FEH    VREL   CCPEAK    CCP0   CHISQ   VREL0')
     for i in range(len(samples)):
         m = models([samples['teff'][i],samples['logg'][i],samples['feh'][i]],rv=0,wave=wavelog)
         mcont = polynorm(m.flux,obs.mask)
         m.flux /= mcont
-        outstr1 = specxcorr(m.wave,m.flux,obs.flux,obs.err,maxlag,plot=plot)
+        outstr1 = specxcorr(m.wave,m.flux,obs.flux,obs.err,maxlag,plot=plot,obsprep=obsprep,
+                            out=xcorrstr[i:i+1])
         #if outstr1['chisq'] > 1000:
         #    import pdb; pdb.set_trace()
         if verbose is True:
@@ -1256,7 +1319,7 @@ def fit_lsq(spec,models=None,initpar=None,verbose=False,maxvel=[-1000,1000],logg
     for p in models:
         lbounds[0:3] = np.minimum(lbounds[0:3],np.min(p.ranges,axis=1))
         ubounds[0:3] = np.maximum(ubounds[0:3],np.max(p.ranges,axis=1))
-    logger.info('fit_lsq: '+str(maxvel))
+    if verbose is True: logger.info('fit_lsq: '+str(maxvel))
     lbounds[3] = maxvel[0]
     ubounds[3] = maxvel[1]
     bounds = (lbounds, ubounds)
@@ -1360,7 +1423,7 @@ def fit_mcmc(spec,models=None,initpar=None,steps=100,cornername=None,verbose=Fal
     if cornername is not None: steps=np.maximum(steps,500)  # at least 500 steps
     out = sampler.run_mcmc(pos, steps)
 
-    samples = sampler.chain[:, np.int(steps/2):, :].reshape((-1, ndim))
+    samples = sampler.chain[:, int(steps/2):, :].reshape((-1, ndim))
 
     # Get the median and stddev values
     pars = np.zeros(ndim,float)
@@ -1711,7 +1774,7 @@ def fit(spectrum,models=None,verbose=False,mcmc=False,figfile=None,cornername=No
 
     # Make sure the labels are within the ranges
     labels0 = labels0.flatten()
-    for i in range(3): labels0[i]=dln.limit(labels0[i],bestmodelinterp.ranges[i,0],bestmodelinterp.ranges[i,1])
+    for i in range(3): labels0[i]=np.clip(labels0[i],bestmodelinterp.ranges[i,0],bestmodelinterp.ranges[i,1])
     bestmodelspec0 = bestmodelinterp(labels0)
     if verbose is True:
         logger.info('Initial Cannon stellar parameters using initial RV')
@@ -1726,7 +1789,7 @@ def fit(spectrum,models=None,verbose=False,mcmc=False,figfile=None,cornername=No
     labels, cov, meta = bestmodelinterp.test(specm)
     # Make sure the labels are within the ranges
     labels = labels.flatten()
-    for i in range(3): labels[i]=dln.limit(labels[i],bestmodelinterp.ranges[i,0],bestmodelinterp.ranges[i,1])
+    for i in range(3): labels[i]=np.clip(labels[i],bestmodelinterp.ranges[i,0],bestmodelinterp.ranges[i,1])
     bestmodelspec = bestmodelinterp(labels)
     if verbose is True:
         logger.info('Initial Cannon stellar parameters using initial RV and Tweaking the normalization')
@@ -1762,7 +1825,7 @@ def fit(spectrum,models=None,verbose=False,mcmc=False,figfile=None,cornername=No
     labels2, cov2, meta2 = bestmodelinterp.test(specm)
     # Make sure the labels are within the ranges
     labels2 = labels2.flatten()
-    for i in range(3): labels2[i]=dln.limit(labels2[i],bestmodelinterp.ranges[i,0],bestmodelinterp.ranges[i,1])
+    for i in range(3): labels2[i]=np.clip(labels2[i],bestmodelinterp.ranges[i,0],bestmodelinterp.ranges[i,1])
     bestmodelspec2 = bestmodelinterp(labels2)
     if verbose is True:
         logger.info('Improved RV and Cannon stellar parameters:')
@@ -1907,7 +1970,7 @@ def jointfit(speclist,models=None,mcmc=False,snrcut=10.0,saveplot=False,verbose=
         snrcut=0
     elif nhisnr < np.ceil(0.25*nspec):
         snr = np.flip(np.sort(info['snr']))
-        snrcut = snr[np.maximum(np.int(np.ceil(0.25*nspec)),np.minimum(4,nspec-1))]
+        snrcut = snr[np.maximum(int(math.ceil(0.25*nspec)),np.minimum(4,nspec-1))]
         if verbose is True:
             logger.info('Lowering S/N cut to %5.1f so at least 25%% of the spectra pass the cut' % snrcut)
         
@@ -2210,24 +2273,21 @@ def final_xcorr(sp,model,pars,rv,maxvel=[-500,500],plot=False) :
     nlag = maxlag[1]-maxlag[0]+1
     if ((nlag % 2) == 0): nlag +=1  # make sure nlag is odd
     outstr = specxcorr(m.wave,m.flux,obs.flux,obs.err,maxlag,plot=plot)
-    outstr['ccvlag'] = rv+(maxlag[0]+np.arange(nlag))*dwlog*cspeed*np.log(10)
+    outstr['ccvlag'] = rv+(maxlag[0]+np.arange(nlag))*dwlog*cspeed*LN10
     return outstr
 
 def polynorm(flux,mask,order=4) :
     """ simple polynomial continuum
     """
-    x = np.arange(flux.shape[0])
-    cont = np.full_like(flux,1.)
-    if len(flux.shape) > 1 :
-        norder = flux.shape[1]
-        for iorder in range(norder) :
-            gd=np.where(~mask[:,iorder] & np.isfinite(flux[:,iorder]))[0]
-            if len(gd) > order :
-                coef = np.polyfit(x[gd],flux[gd,iorder],order)
-                cont[:,iorder] = np.polyval(coef,x)
-    else :
-            gd=np.where(~mask & np.isfinite(flux))[0]
-            if len(gd) > order :
-                coef = np.polyfit(x[gd],flux[gd],order)
-                cont = np.polyval(coef,x)
-    return cont
+    npix = flux.shape[0]
+    # Vandermonde matrix on a scaled pixel axis, shared by all orders
+    vander = np.polynomial.polynomial.polyvander(np.linspace(-1.0,1.0,npix),order)
+    flux2 = flux.reshape(npix,-1)
+    good = ~mask.reshape(npix,-1) & np.isfinite(flux2)
+    cont = np.full_like(flux2,1.)
+    for iorder in range(flux2.shape[1]) :
+        gd = good[:,iorder]
+        if np.sum(gd) > order :
+            coef = np.linalg.lstsq(vander[gd],flux2[gd,iorder],rcond=None)[0]
+            cont[:,iorder] = vander @ coef
+    return cont.reshape(flux.shape)
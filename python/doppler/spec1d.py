@@ -211,6 +211,18 @@ class Spec1D:
         return s
 
     
+    def _dispersion_interp(self,order=0,inverse=False):
+        """ Return the dispersion solution interpolation for an order, set up once and reused."""
+        if getattr(self,'_dispwave',None) is not self.wave:   # new wavelengths, start over
+            self._dispwave = self.wave
+            self._dispcache = {}
+        key = (order,inverse)
+        if key not in self._dispcache:
+            wave = self.wave[:,order] if self.wave.ndim==2 else self.wave
+            self._dispcache[key] = utils.dispersion_interp(wave,inverse=inverse)
+        return self._dispcache[key]
+
+        
     def wave2pix(self,w,extrapolate=True,order=0):
         """
         Convert wavelength values to pixels using the spectrum dispersion
@@ -243,9 +255,9 @@ class Spec1D:
             raise Exception("No wavelength information")
         if self.wave.ndim==2:
             # Order is always the second dimension
-            return utils.w2p(self.wave[:,order],w,extrapolate=extrapolate)            
+            return utils.w2p(self.wave[:,order],w,extrapolate=extrapolate,interp=self._dispersion_interp(order,inverse=True))            
         else:
-            return utils.w2p(self.wave,w,extrapolate=extrapolate)
+            return utils.w2p(self.wave,w,extrapolate=extrapolate,interp=self._dispersion_interp(order,inverse=True))
 
         
     def pix2wave(self,x,extrapolate=True,order=0):
@@ -280,9 +292,9 @@ class Spec1D:
             raise Exception("No wavelength information")
         if self.wave.ndim==2:
              # Order is always the second dimension
-            return utils.p2w(self.wave[:,order],x,extrapolate=extrapolate)
+            return utils.p2w(self.wave[:,order],x,extrapolate=extrapolate,interp=self._dispersion_interp(order))
         else:
-            return utils.p2w(self.wave,x,extrapolate=extrapolate)            
+            return utils.p2w(self.wave,x,extrapolate=extrapolate,interp=self._dispersion_interp(order))            
 
         
     def normalize(self,ncorder=6,perclevel=0.95):
@@ -316,30 +328,29 @@ class Spec1D:
 
         binsize = 0.10
         perclevel = 90.0
-        wave = self.wave.copy().reshape(self.npix,self.norder)   # make 2D
+        # Only flux and err are modified in place, the original flux is kept in _flux
+        wave = self.wave.reshape(self.npix,self.norder)          # make 2D
         flux = self.flux.copy().reshape(self.npix,self.norder)   # make 2D
         err = self.err.copy().reshape(self.npix,self.norder)     # make 2D
-        mask = self.mask.copy().reshape(self.npix,self.norder)   # make 2D
-        cont = err.copy()*0.0+1
+        mask = self.mask.reshape(self.npix,self.norder)          # make 2D
+        cont = np.ones_like(err)
         for o in range(self.norder):
-            w = wave[:,o].copy()
-            x = (w-np.median(w))/(np.max(w*0.5)-np.min(w*0.5))  # -1 to +1
-            y = flux[:,o].copy()
+            w = wave[:,o]
+            x = (w-np.median(w))/(0.5*(np.max(w)-np.min(w)))  # -1 to +1
             m = mask[:,o].copy()
             # Divide by median
-            medy = np.nanmedian(y)
-            y /= medy
+            medy = np.nanmedian(flux[:,o])
+            y = flux[:,o]/medy
             # Perform sigma clipping out large positive outliers
-            coef = dln.poly_fit(x,y,2,robust=True)
-            sig = dln.mad(y-dln.poly(x,coef))
-            bd,nbd = dln.where((y-dln.poly(x,coef)) > 5*sig)
+            coef = utils.poly_fit(x,y,2,robust=True)
+            sig = dln.mad(y-utils.poly(x,coef))
+            bd,nbd = dln.where((y-utils.poly(x,coef)) > 5*sig)
             if nbd>0: m[bd]=True
             gdmask = (y>0) & (m==False)        # need positive fluxes and no mask set          
             # Bin the data points
             xr = [np.nanmin(x),np.nanmax(x)]
             bins = np.ceil((xr[1]-xr[0])/binsize)+1
-            ybin, bin_edges, binnumber = bindata.binned_statistic(x[gdmask],y[gdmask],statistic='percentile',
-                                                                  percentile=perclevel,bins=bins,range=None)
+            ybin, bin_edges, binnumber = utils.binned_percentile(x[gdmask],y[gdmask],bins,percentile=perclevel)
             xbin = bin_edges[0:-1]+0.5*binsize
             # Interpolate to full grid
             fnt = np.isfinite(ybin)
@@ -482,19 +493,12 @@ class Spec1D:
 
     def copy(self):
         """ Create a new copy."""
-        if self.lsf.pars is not None:
-            newlsfpars = self.lsf.pars.copy()
-        else:
-            newlsfpars = None
-        new = Spec1D(self.flux.copy(),err=self.err.copy(),wave=self.wave.copy(),mask=self.mask.copy(),
-                     lsfpars=newlsfpars,lsftype=self.lsf.lsftype,lsfxtype=self.lsf.xtype,
-                     lsfsigma=self.lsf.sigma,instrument=self.instrument,filename=self.filename)
-        new.lsf = copy.deepcopy(self.lsf)  # make sure all parts of Lsf are copied over
-        for name, value in vars(self).items():
-            if name not in ['flux','wave','err','mask','lsf','instrument','filename']:
-                setattr(new,name,copy.deepcopy(value))           
-
-        return new
+        # Copy everything, but let Lsf.copy() share the LSF array and
+        #  start the copy with an empty wavelength interpolator cache
+        memo = {id(self.lsf): self.lsf.copy()}
+        if getattr(self,'_dispcache',None) is not None:
+            memo[id(self._dispcache)] = {}
+        return copy.deepcopy(self,memo)
 
     def barycorr(self):
         """ calculate the barycentric correction."""
@@ -10,10 +10,12 @@ __authors__ = 'David Nidever <dnidever@noao.edu>'
 __version__ = '20200112'  # yyyymmdd                                                                                                                           
 
 import os
+import math
 import numpy as np
 import warnings
 from scipy import sparse
 from scipy.interpolate import interp1d
+from scipy.optimize import curve_fit, least_squares
 from dlnpyutils import utils as dln
 import matplotlib.pyplot as plt
 
@@ -24,8 +26,369 @@ warnings.filterwarnings("ignore", message="numpy.ufunc size changed")
 cspeed = 2.99792458e5  # speed of light in km/s
 
 
+def poly(x,coef):
+    """
+    Evaluate a polynomial function of a variable.
+
+    This uses Horner's scheme so no powers of x need to be computed.
+
+    Parameters
+    ----------
+    x : array
+      Array of values at which to evaluate the polynomial.
+    coef : array
+      Polynomial coefficients in increasing order,
+      y = coef[0] + coef[1]*x + coef[2]*x**2 + ...
+
+    Returns
+    -------
+    y : array
+      The polynomial evaluated at x.
+
+    Examples
+    --------
+    y = poly(x,coef)
+
+    """
+
+    x = np.asarray(x)
+    coef = np.asarray(coef)
+    y = np.full_like(x,coef[-1],dtype=float)
+    for c in coef[-2::-1]:
+        y = y*x + c
+    return y
+
+
+def poly_resid(coef,x,y,sigma=1.0):
+    """ Helper function for poly_fit() that returns the weighted residuals."""
+    return (np.polynomial.polynomial.polyval(x,coef)-y)/sigma
+
+
+def poly_jac(coef,x,y,sigma=1.0):
+    """ Helper function for poly_fit() that returns the Jacobian of the weighted residuals."""
+    return np.polynomial.polynomial.polyvander(x,len(coef)-1)/np.reshape(sigma,(-1,1))
+
+
+def poly_fit(x,y,nord,robust=False,sigma=None,initpar=None):
+    """
+    Fit a polynomial to data.
+
+    Parameters
+    ----------
+    x : array
+      Array of X values.
+    y : array
+      Array of Y values.
+    nord : int
+      Polynomial order.
+    robust : bool, optional
+      Use a robust (soft_l1) loss function.  Default is False.
+    sigma : array, optional
+      Uncertainties in Y.
+    initpar : array, optional
+      Initial guess of the coefficients.  Default is all zeros.
+
+    Returns
+    -------
+    coef : array
+      Polynomial coefficients in increasing order (see poly()).
+
+    Examples
+    --------
+    coef = poly_fit(x,y,2,robust=True)
+
+    """
+
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if initpar is None: initpar = np.zeros(nord+1,float)
+    if robust==True:
+        loss = 'soft_l1'
+        f_scale = 0.1
+    else:
+        loss = 'linear'
+        f_scale = 1.0
+    if sigma is None: sigma=np.zeros(len(x),float)+1
+    sigma = np.asarray(sigma)
+    # The model is linear in the coefficients so the Jacobian is exact
+    res = least_squares(poly_resid, initpar, loss=loss, f_scale=f_scale, args=(x,y,sigma), jac=poly_jac)
+    if res.success is False:
+        warnings.warn("Problem with least squares polynomial fitting. Status="+str(res.status)+" Trying np.polyfit instead.")
+        # np.polyfit returns the coefficients in decreasing order, and its weights are 1/sigma
+        return np.polyfit(x,y,nord,w=1/sigma)[::-1]
+    return res.x
+
+
+def gaussian(x,amp,cen,sig,const=0.0):
+    """
+    1-D Gaussian with a constant offset.
+
+    Parameters
+    ----------
+    x : array
+      The array of X values.
+    amp : float
+      The Gaussian height/amplitude.
+    cen : float
+      The central position of the Gaussian.
+    sig : float
+      The Gaussian sigma.
+    const : float, optional
+      A constant offset.  Default is 0.0.
+
+    Returns
+    -------
+    g : array
+      The Gaussian evaluated at x.
+
+    Examples
+    --------
+    g = gaussian(x,amp,cen,sig,const)
+
+    """
+    return amp * np.exp(-0.5*(x-cen)**2/sig**2) + const
+
+
+def gaussian_jac(x,amp,cen,sig,const=0.0):
+    """ Helper function for gaussfit() that returns the analytic Jacobian of gaussian(), [Nx,4]."""
+    xcen = x-cen
+    g0 = np.exp(-0.5*xcen**2/sig**2)
+    jac = np.empty((len(x),4),float)
+    jac[:,0] = g0
+    jac[:,1] = amp*g0*xcen/sig**2
+    jac[:,2] = amp*g0*xcen**2/sig**3
+    jac[:,3] = 1.0
+    return jac
+
+
+def gaussfit(x,y,initpar=None,sigma=None,bounds=None,loss='linear',f_scale=1.0):
+    """
+    Fit a 1-D Gaussian with a constant offset to X/Y data.
+
+    This uses the analytic Jacobian of gaussian().
+
+    Parameters
+    ----------
+    x : array
+      The array of X values.
+    y : array
+      The array of Y values.
+    initpar : list, optional
+      Initial guess [amp, cen, sig, const].
+    sigma : array, optional
+      Uncertainties in Y.
+    bounds : tuple, optional
+      Lower and upper bounds on the parameters.
+    loss : str, optional
+      The least_squares() loss function, e.g. 'soft_l1' for a robust fit.
+        Default is 'linear' (normal least squares).
+    f_scale : float, optional
+      The soft margin between inlier and outlier residuals for a robust loss.
+        Default is 1.0.
+
+    Returns
+    -------
+    pars : array
+      The best-fit parameters.
+    cov : array
+      The covariance matrix.
+
+    Examples
+    --------
+    pars,cov = gaussfit(x,y,initpar,sigma)
+
+    """
+    if initpar is None:
+        initpar = [np.max(y),x[np.argmax(y)],1.0,np.median(y)]
+    if bounds is None:
+        bounds = (-np.inf,np.inf)
+    if loss != 'linear':
+        # robust loss functions need the trust region method
+        return curve_fit(gaussian, x, y, p0=initpar, sigma=sigma, bounds=bounds, jac=gaussian_jac, check_finite=False,
+                         method='trf', loss=loss, f_scale=f_scale)
+    return curve_fit(gaussian, x, y, p0=initpar, sigma=sigma, bounds=bounds, jac=gaussian_jac, check_finite=False)
+
+
+def rebin(arr,nbin):
+    """
+    Rebin an array along the first dimension by averaging.
+
+    The bins are evenly spaced in index, but the length of the array
+    does not need to be a multiple of the number of bins.
+
+    Parameters
+    ----------
+    arr : array
+      The 1D or 2D array to rebin.  2D arrays are rebinned along the first
+      dimension, e.g. [Npix,Npars].
+    nbin : int
+      The number of output bins.
+
+    Returns
+    -------
+    out : array
+      The rebinned array.
+
+    Examples
+    --------
+    out = rebin(arr,100)
+
+    """
+    arr = np.asarray(arr)
+    n = arr.shape[0]
+    if (nbin<1) | (nbin>n):
+        raise ValueError("nbin must be between 1 and the length of arr")
+    idx = np.linspace(0,n,nbin+1).astype(int)
+    cnt = np.diff(idx).reshape((-1,)+(1,)*(arr.ndim-1))
+    return np.add.reduceat(arr,idx[0:-1],axis=0)/cnt
+
+
+def closest_index(arr,val):
+    """
+    Find the index of the element of a sorted array that is closest to a value.
+
+    This uses a binary search instead of scanning the entire array.
+
+    Parameters
+    ----------
+    arr : array
+      Monotonically increasing array.
+    val : float
+      The value to find.
+
+    Returns
+    -------
+    ind : int
+      The index of the closest element.  The lower index is returned for ties.
+
+    Examples
+    --------
+    ind = closest_index(wave,5500.0)
+
+    """
+    n = len(arr)
+    ind = np.searchsorted(arr,val)
+    if ind <= 0: return 0
+    if ind >= n: return n-1
+    if (val-arr[ind-1]) <= (arr[ind]-val): return ind-1
+    return ind
+
+
+def binned_percentile(x,y,bins=10,percentile=50.0,binnumber=None):
+    """
+    Compute a percentile of y in equal-width bins of x.
+
+    This gives the same result as bindata.binned_statistic() with
+    statistic='percentile', but without a loop over the bins.  The values
+    are sorted within each bin at once and the percentiles are interpolated
+    from the bin offsets.  As with np.percentile, a bin with a NaN value
+    gives NaN.
+
+    Parameters
+    ----------
+    x : array
+      The values to bin.
+    y : array
+      The values on which the percentile is computed.
+    bins : int, default=10
+      The number of equal-width bins between the minimum and maximum of x.
+    percentile : float, default=50
+      The percentile to compute.
+    binnumber : array, optional
+      Bin numbers from a previous call with the same x and bins.
+        This skips the binning step.
+
+    Returns
+    -------
+    ybin : array
+      The percentile of y in each bin.  Empty bins are NaN.
+    bin_edges : array
+      The bin edges.
+    binnumber : array
+      The bin number (0 to bins-1) of each element of x.
+
+    Examples
+    --------
+    ybin, bin_edges, binnumber = binned_percentile(x,y,40,percentile=95)
+
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    nbins = int(bins)
+    xmin,xmax = float(np.min(x)),float(np.max(x))
+    if xmin==xmax:
+        xmin,xmax = xmin-0.5,xmax+0.5
+    bin_edges = np.linspace(xmin,xmax,nbins+1)
+    if binnumber is None:
+        binnumber = np.digitize(x,bin_edges)-1
+        binnumber[binnumber==nbins] = nbins-1   # rightmost edge goes in the last bin
+    # Sort by bin number and then by value, so each bin is a sorted
+    #  contiguous slice starting at offset
+    counts = np.bincount(binnumber,minlength=nbins)
+    offset = np.cumsum(counts)-counts
+    ysort = y[np.lexsort((y,binnumber))]
+    # Linear interpolation between the closest ranks, like np.percentile
+    nnan = np.bincount(binnumber,weights=np.isnan(y),minlength=nbins)
+    gd = (counts>0) & (nnan==0)
+    rank = percentile/100.0*(counts[gd]-1)
+    ilo = np.floor(rank).astype(int)
+    ihi = np.minimum(ilo+1,counts[gd]-1)
+    ylo = ysort[offset[gd]+ilo]
+    yhi = ysort[offset[gd]+ihi]
+    ybin = np.full(nbins,np.nan)
+    ybin[gd] = ylo + (yhi-ylo)*(rank-ilo)
+    return ybin, bin_edges, binnumber
+
+
+# Set up the conversion between wavelengths and pixels for a dispersion solution
+def dispersion_interp(dispersion,inverse=False):
+    """
+    Helper function for w2p() and p2w() that sets up the interpolation and
+    extrapolation for a dispersion solution, so it can be reused.
+
+    Parameters
+    ----------
+    dispersion : 1D array
+         The dispersion solution.  This is basically just a 1D array of
+         monotonically increasing (or decreasing) wavelengths.
+    inverse : bool, optional
+         Set up the wavelength to pixel conversion (w2p) instead of the
+         pixel to wavelength conversion (p2w).  False by default.
+
+    Returns
+    -------
+    interp : tuple
+      The cubic interpolating function, the lower and upper limits of its
+      input values, and the quadratic extrapolation coefficients for the
+      low and high ends.
+
+    Examples
+    --------
+    interp = dispersion_interp(disp,inverse=True)
+    x = w2p(disp,w,interp=interp)
+
+    """
+
+    npix = len(dispersion)
+    xin = np.arange(npix)
+    # Wavelengths to pixels
+    if inverse:
+        func = interp1d(dispersion,xin,kind='cubic',bounds_error=False,fill_value=(np.nan,np.nan),assume_sorted=False)
+        si = np.argsort(dispersion)
+        vin = dispersion[si]
+        yin = xin[si]
+    # Pixels to wavelengths
+    else:
+        func = interp1d(xin,dispersion,kind='cubic',bounds_error=False,fill_value=(np.nan,np.nan),assume_sorted=False)
+        vin = xin
+        yin = dispersion
+    coef1 = poly_fit(vin[0:10], yin[0:10], 2)
+    coef2 = poly_fit(vin[npix-10:], yin[npix-10:], 2)
+    return (func,vin[0],vin[-1],coef1,coef2)
+
+
 # Convert wavelengths to pixels for a dispersion solution
-def w2p(dispersion,w,extrapolate=True):
+def w2p(dispersion,w,extrapolate=True,interp=None):
     """
     Convert wavelength values to pixels for a "dispersion solution".
 
@@ -39,6 +402,9 @@ def w2p(dispersion,w,extrapolate=True):
     extrapolate : bool, optional
        Extrapolate beyond the dispersion solution, if necessary.
        This is True by default.
+    interp : tuple, optional
+       The output of dispersion_interp() for this dispersion solution.  This
+       is used to avoid setting up the interpolation again on repeated calls.
 
     Returns
     -------
@@ -51,30 +417,26 @@ def w2p(dispersion,w,extrapolate=True):
 
     """
 
-    x = interp1d(dispersion,np.arange(len(dispersion)),kind='cubic',bounds_error=False,fill_value=(np.nan,np.nan),assume_sorted=False)(w)
+    if interp is None:
+        interp = dispersion_interp(dispersion,inverse=True)
+    func,wmin,wmax,coef1,coef2 = interp
+    w = np.asarray(w)
+    x = func(w)
     # Need to extrapolate
-    if ((np.min(w)<np.min(dispersion)) | (np.max(w)>np.max(dispersion))) & (extrapolate is True):
-        win = dispersion
-        xin = np.arange(len(dispersion))
-        si = np.argsort(win)
-        win = win[si]
-        xin = xin[si]
-        npix = len(win)
+    if extrapolate is True:
         # At the beginning
-        if (np.min(w)<np.min(dispersion)):
-            coef1 = dln.poly_fit(win[0:10], xin[0:10], 2)
-            bd1, nbd1 = dln.where(w < np.min(dispersion))
-            x[bd1] = dln.poly(w[bd1],coef1)
+        bd1 = (w < wmin)
+        if np.any(bd1):
+            x[bd1] = poly(w[bd1],coef1)
         # At the end
-        if (np.max(w)>np.max(dispersion)):
-            coef2 = dln.poly_fit(win[npix-10:], xin[npix-10:], 2)
-            bd2, nbd2 = dln.where(w > np.max(dispersion))
-            x[bd2] = dln.poly(w[bd2],coef2)                
+        bd2 = (w > wmax)
+        if np.any(bd2):
+            x[bd2] = poly(w[bd2],coef2)
     return x
 
 
 # Convert pixels to wavelength for a dispersion solution
-def p2w(dispersion,x,extrapolate=True):
+def p2w(dispersion,x,extrapolate=True,interp=None):
     """
     Convert pixel values to wavelengths for a "dispersion solution".
 
@@ -88,6 +450,9 @@ def p2w(dispersion,x,extrapolate=True):
     extrapolate : bool, optional
        Extrapolate beyond the dispersion solution, if necessary.
        This is True by default.
+    interp : tuple, optional
+       The output of dispersion_interp() for this dispersion solution.  This
+       is used to avoid setting up the interpolation again on repeated calls.
 
     Returns
     -------
@@ -100,22 +465,21 @@ def p2w(dispersion,x,extrapolate=True):
 
     """
 
-    npix = len(dispersion)
-    w = interp1d(np.arange(len(dispersion)),dispersion,kind='cubic',bounds_error=False,fill_value=(np.nan,np.nan),assume_sorted=False)(x)
+    if interp is None:
+        interp = dispersion_interp(dispersion)
+    func,xmin,xmax,coef1,coef2 = interp
+    x = np.asarray(x)
+    w = func(x)
     # Need to extrapolate
-    if ((np.min(x)<0) | (np.max(x)>(npix-1))) & (extrapolate is True):
-        xin = np.arange(npix)
-        win = dispersion
+    if extrapolate is True:
         # At the beginning
-        if (np.min(x)<0):
-            coef1 = dln.poly_fit(xin[0:10], win[0:10], 2)
-            bd1, nbd1 = dln.where(x < 0)
-            w[bd1] = dln.poly(x[bd1],coef1)
+        bd1 = (x < xmin)
+        if np.any(bd1):
+            w[bd1] = poly(x[bd1],coef1)
         # At the end
-        if (np.max(x)>(npix-1)):
-            coef2 = dln.poly_fit(xin[npix-10:], win[npix-10:], 2)
-            bd2, nbd2 = dln.where(x > (npix-1))
-            w[bd2] = dln.poly(x[bd2],coef2)                
+        bd2 = (x > xmax)
+        if np.any(bd2):
+            w[bd2] = poly(x[bd2],coef2)
     return w
 
 
@@ -158,10 +522,14 @@ def convolve_sparse(spec,lsf):
     """
     Convolve a flux array (1D) with an LSF (2D) using sparse matrices.
 
+    Multiple flux arrays that share the same LSF can be convolved at once
+    by passing them as the columns of a 2D array, so the sparse LSF matrix
+    is only built once.
+
     Parameters
     ----------
-    spec : 1D array
-         The 1D flux array [Npix].
+    spec : array
+         The 1D flux array [Npix], or a 2D array of flux arrays [Npix,Nspec].
     lsf : 2D array
          The Line Spread Function (LSF) to convolve the spectrum with.  This must
          have shape of [Npix,Nlsf].
@@ -169,7 +537,7 @@ def convolve_sparse(spec,lsf):
     Returns
     -------
     out : array
-         The new flux array convolved with LSF.
+         The new flux array convolved with LSF.  Same shape as spec.
 
     Usage
     -----
@@ -179,23 +547,22 @@ def convolve_sparse(spec,lsf):
     """
 
     npix,nlsf = lsf.shape
+    spec = np.asarray(spec)
+    spec2 = spec.reshape(npix,-1)
     lsf2 = sparsify(lsf)
-    spec2 = np.reshape(spec,(1,npix))
-    spec2 = sparse.csr_matrix(spec2) 
-    out = lsf2.dot(spec2.T).T.toarray()
-    out = np.reshape(out,len(spec))
+    out = lsf2.dot(spec2)
     # The ends are messed up b/c not normalized
     hlf = nlsf//2
     for i in range(hlf+1):
         lsf1 = lsf[i,hlf-i:]
-        lsf1 /= np.sum(lsf1)
-        out[i] = np.sum(spec[0:len(lsf1)]*lsf1)
+        lsf1 = lsf1/np.sum(lsf1)
+        out[i] = lsf1.dot(spec2[0:len(lsf1)])
     for i in range(hlf+1):
         ii = npix-i-1
         lsf1 = lsf[ii,:hlf+1+i]
-        lsf1 /= np.sum(lsf1)
-        out[ii] = np.sum(spec[npix-len(lsf1):]*lsf1)
-    return out
+        lsf1 = lsf1/np.sum(lsf1)
+        out[ii] = lsf1.dot(spec2[npix-len(lsf1):])
+    return out.reshape(spec.shape)
 
 
 # Make logaritmic wavelength scale
@@ -233,37 +600,31 @@ def make_logwave_scale(wave,vel=1000.0):
     # on either side
     vel = np.abs(vel)
     wave = np.float64(wave)
+    logw = np.log10(wave)   # only take the log once
     nw = len(wave)
-    wr = dln.minmax(wave)
 
     # Multi-order wavelength array
     if wave.ndim==2:
         norder = wave.shape[1]
 
         # Ranges
-        wr = np.empty((2,norder),np.float64)
-        wlo = np.empty(norder,np.float64)
-        whi = np.empty(norder,np.float64)
-        for i in range(norder):
-            wr[:,i] = dln.minmax(wave[:,i])
-            wlo[i] = wr[0,i]-vel/cspeed*wr[0,i]
-            whi[i] = wr[1,i]+vel/cspeed*wr[1,i]
+        wr = np.vstack((np.min(wave,axis=0),np.max(wave,axis=0)))
+        wlo = wr[0]-vel/cspeed*wr[0]
+        whi = wr[1]+vel/cspeed*wr[1]
+        logwr = np.log10(wr)
             
         # For multi-order wavelengths, the final wavelength solution will extend
         # beyond the boundary of the original wavelength solution (at the end).
         # The extra pixels will have to be "padded" with masked out values.
         
         # We want the same logarithmic step for all order
-        dw = np.log10(np.float64(wave[1:,:])) - np.log10(np.float64(wave[0:-1,:]))
+        dw = np.diff(logw,axis=0)
         dwlog = np.median(np.abs(dw))   # positive
 
         # Extend at the ends
         if vel>0:
-            nlo = np.empty(norder,int)
-            nhi = np.empty(norder,int)
-            for i in range(norder):
-                nlo[i] = np.int(np.ceil((np.log10(np.float64(wr[0,i]))-np.log10(np.float64(wlo[i])))/dwlog))
-                nhi[i] = np.int(np.ceil((np.log10(np.float64(whi[i]))-np.log10(np.float64(wr[1,i])))/dwlog))
+            nlo = np.ceil((logwr[0]-np.log10(wlo))/dwlog).astype(int)
+            nhi = np.ceil((np.log10(whi)-logwr[1])/dwlog).astype(int)
             # Use the maximum over all orders
             nlo = np.max(nlo)
             nhi = np.max(nhi)
@@ -272,12 +633,10 @@ def make_logwave_scale(wave,vel=1000.0):
             nhi = 0
 
         # Number of pixels for the input wavelength range
-        n = np.empty(norder,int)
-        for i in range(norder):
-            if vel==0:
-                n[i] = np.int((np.log10(np.float64(wr[1,i]))-np.log10(np.float64(wr[0,i])))/dwlog)
-            else:
-                n[i] = np.int(np.ceil((np.log10(np.float64(wr[1,i]))-np.log10(np.float64(wr[0,i])))/dwlog))        
+        if vel==0:
+            n = ((logwr[1]-logwr[0])/dwlog).astype(int)
+        else:
+            n = np.ceil((logwr[1]-logwr[0])/dwlog).astype(int)
         # maximum over all orders
         n = np.max(n)
 
@@ -285,9 +644,7 @@ def make_logwave_scale(wave,vel=1000.0):
         nf = n+nlo+nhi
 
         # Final wavelength array
-        fwave = np.empty((nf,norder),np.float64)
-        for i in range(norder):
-            fwave[:,i] = 10**( (np.arange(nf)-nlo)*dwlog+np.log10(np.float64(wr[0,i])) )
+        fwave = 10**( (np.arange(nf)-nlo).reshape(-1,1)*dwlog+logwr[0] )
 
         # Make sure the element that's associated with the first input wavelength is identical
         for i in range(norder):
@@ -300,29 +657,31 @@ def make_logwave_scale(wave,vel=1000.0):
         
     # Single-order wavelength array
     else:
+        wr = dln.minmax(wave)
         # extend wavelength range by +/-vel km/s
         wlo = wr[0]-vel/cspeed*wr[0]
         whi = wr[1]+vel/cspeed*wr[1]
+        logwr = np.log10(wr)
 
         # logarithmic step
-        dwlog = np.median(dln.slope(np.log10(np.float64(wave))))
+        dwlog = np.median(np.diff(logw))
         
         # extend at the ends
         if vel>0:
-            nlo = np.int(np.ceil((np.log10(np.float64(wr[0]))-np.log10(np.float64(wlo)))/dwlog))    
-            nhi = np.int(np.ceil((np.log10(np.float64(whi))-np.log10(np.float64(wr[1])))/dwlog))        
+            nlo = int(math.ceil((logwr[0]-np.log10(wlo))/dwlog))
+            nhi = int(math.ceil((np.log10(whi)-logwr[1])/dwlog))
         else:
             nlo = 0
             nhi = 0
 
         # Number of pixels
         if vel==0.0:
-            n = np.int((np.log10(np.float64(wr[1]))-np.log10(np.float64(wr[0])))/dwlog)
+            n = int((logwr[1]-logwr[0])/dwlog)
         else:
-            n = np.int(np.ceil((np.log10(np.float64(wr[1]))-np.log10(np.float64(wr[0])))/dwlog))        
+            n = int(math.ceil((logwr[1]-logwr[0])/dwlog))
         nf = n+nlo+nhi
 
-        fwave = 10**( (np.arange(nf)-nlo)*dwlog+np.log10(np.float64(wr[0])) )
+        fwave = 10**( (np.arange(nf)-nlo)*dwlog+logwr[0] )
 
         # Make sure the element that's associated with the first input wavelength is identical
         fwave -= fwave[nlo]-wave[0]
@@ -451,19 +810,19 @@ def maskoutliers(spec,nsig=5,verbose=False,logger=None):
     totnbd = 0
     for o in range(spec2.norder):
         w = wave[:,o].copy()
-        x = (w-np.median(w))/(np.max(w*0.5)-np.min(w*0.5))  # -1 to +1
+        x = (w-np.median(w))/(0.5*(np.max(w)-np.min(w)))  # -1 to +1
         y = flux[:,o].copy()
         m = mask[:,o].copy()
         # Divide by median
         medy = np.nanmedian(y)
         y /= medy
         # Perform sigma clipping out large positive outliers
-        coef = dln.poly_fit(x,y,2,robust=True)
-        sig = dln.mad(y-dln.poly(x,coef))
-        bd,nbd = dln.where( ((y-dln.poly(x,coef)) > nsig*sig) | (y<0))
+        coef = poly_fit(x,y,2,robust=True)
+        sig = dln.mad(y-poly(x,coef))
+        bd,nbd = dln.where( ((y-poly(x,coef)) > nsig*sig) | (y<0))
         totnbd += nbd
         if nbd>0:
-            flux[bd,o] = dln.poly(x[bd],coef)*medy
+            flux[bd,o] = poly(x[bd],coef)*medy
             err[bd,o] = 1e30
             mask[bd,o] = True
 
@@ -501,7 +860,7 @@ def maskdiscrepant(spec,model,nsig=10,verbose=False,logger=None):
     totnbd = 0
     for o in range(spec2.norder):
         w = wave[:,o].copy()
-        x = (w-np.median(w))/(np.max(w*0.5)-np.min(w*0.5))  # -1 to +1
+        x = (w-np.median(w))/(0.5*(np.max(w)-np.min(w)))  # -1 to +1
         y = flux[:,o].copy()
         m = mask[:,o].copy()
         my = mflux[:,o].copy()
@@ -510,12 +869,12 @@ def maskdiscrepant(spec,model,nsig=10,verbose=False,logger=None):
         y /= medy
         my /= medy
         # Perform sigma clipping out large positive outliers
-        coef = dln.poly_fit(x,y,2,robust=True)
+        coef = poly_fit(x,y,2,robust=True)
         sig = dln.mad(y-my)
         bd,nbd = dln.where( np.abs(y-my) > nsig*sig )
         totnbd += nbd
         if nbd>0:
-            flux[bd,o] = dln.poly(x[bd],coef)*medy
+            flux[bd,o] = poly(x[bd],coef)*medy
             err[bd,o] = 1e30
             mask[bd,o] = True
 
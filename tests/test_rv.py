@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""TEST_RV.PY - Regression tests for the doppler rv module
+
+"""
+
+import warnings
+import numpy as np
+import pytest
+from doppler import rv
+
+
+def direct_lagsum(a,b,lag):
+    """ Helper function that computes sum(a[i]*b[i+lag]) for each lag with a loop."""
+    n = a.shape[0]
+    out = np.zeros((len(lag),)+np.broadcast_shapes(a.shape,b.shape)[1:],float)
+    for k,l in enumerate(lag):
+        for i in range(n):
+            if (i+l>=0) & (i+l<n):
+                out[k] += a[i]*b[i+l]
+    return out
+
+
+# Fewer than 32 lags uses direct sums, more uses FFTs
+@pytest.mark.parametrize('lag',[np.arange(-5,6),np.arange(-60,61),np.array([-250,-3,0,7,250]),np.arange(-250,251,10)])
+def test_lagsum(lag):
+    rng = np.random.default_rng(4)
+    a = rng.normal(size=200)
+    b = rng.normal(size=200)
+    np.testing.assert_allclose(rv.lagsum(a,b,lag),direct_lagsum(a,b,lag),atol=1e-10)
+    # Multiple orders, and one array broadcast against the orders
+    a2 = rng.normal(size=(200,3))
+    b2 = rng.normal(size=(200,3))
+    np.testing.assert_allclose(rv.lagsum(a2,b2,lag),direct_lagsum(a2,b2,lag),atol=1e-10)
+    np.testing.assert_allclose(rv.lagsum(a2[:,0:1],b2,lag),direct_lagsum(a2[:,0:1],b2,lag),atol=1e-10)
+
+
+def test_ccorrelate_error():
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=50)
+    y = rng.normal(size=50)
+    yerr = rng.uniform(0.05,0.2,50)
+    # Lags beyond the overlap have (almost) no error instead of NaN
+    lag = np.arange(-60,61,3)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error',RuntimeWarning)
+        cross,cross_error = rv.ccorrelate(x,y,lag,yerr)
+    assert np.all(np.isfinite(cross_error))
+    assert np.all(cross_error[np.abs(lag)>=50] < 1e-6)
+
+
+def test_specxcorr_perror():
+    rng = np.random.default_rng(5)
+    x = np.arange(-10.0,11.0)
+    pars = np.array([1.0,0.3,3.0,0.05])
+    yerr = np.full(len(x),0.02)
+    y = rv.utils.gaussian(x,*pars) + rng.normal(0,0.02,len(x))
+    fpars,cov = rv.utils.gaussfit(x,y,pars,yerr)
+    # For an ordinary least-squares fit this is the curve_fit covariance
+    np.testing.assert_allclose(rv.specxcorr_perror(x,y,yerr,fpars),np.sqrt(np.diag(cov)),rtol=1e-3)
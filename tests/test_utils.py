@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""TEST_UTILS.PY - Regression tests for the doppler utility functions
+
+"""
+
+import warnings
+import numpy as np
+import pytest
+from dlnpyutils import bindata
+from doppler import utils
+
+
+def finite_difference_jac(func,x,pars,eps=1e-6):
+    """ Helper function that returns the central finite-difference Jacobian of func(x,*pars)."""
+    pars = np.asarray(pars,float)
+    jac = np.zeros((len(x),len(pars)),float)
+    for i in range(len(pars)):
+        step = eps*np.maximum(np.abs(pars[i]),1.0)
+        p1,p2 = pars.copy(),pars.copy()
+        p1[i] -= step
+        p2[i] += step
+        jac[:,i] = (func(x,*p2)-func(x,*p1))/(2*step)
+    return jac
+
+
+def test_poly():
+    x = np.linspace(-1,1,100)
+    coef = np.array([1.0,-0.5,0.25,2.0])
+    np.testing.assert_allclose(utils.poly(x,coef),np.polynomial.polynomial.polyval(x,coef))
+    np.testing.assert_allclose(utils.poly(0.5,[3.0]),3.0)
+
+
+def test_poly_fit():
+    x = np.linspace(-1,1,100)
+    coef = np.array([1.0,-0.5,0.25])
+    sigma = np.linspace(0.5,2.0,100)
+    np.testing.assert_allclose(utils.poly_fit(x,utils.poly(x,coef),2,sigma=sigma),coef,atol=1e-6)
+
+
+def test_poly_jac():
+    rng = np.random.default_rng(1)
+    x = np.linspace(-1,1,50)
+    y = rng.normal(size=50)
+    sigma = rng.uniform(0.5,2.0,50)
+    coef = np.array([0.5,-1.0,2.0,0.3])
+    resid = lambda x,*coef: utils.poly_resid(np.array(coef),x,y,sigma)
+    np.testing.assert_allclose(utils.poly_jac(coef,x,y,sigma),finite_difference_jac(resid,x,coef),
+                               rtol=1e-6,atol=1e-8)
+    np.testing.assert_allclose(utils.poly_resid(coef,x,y,sigma),(utils.poly(x,coef)-y)/sigma)
+
+@pytest.mark.parametrize('pars',[[2.0,0.3,1.5,0.1],[0.5,-2.0,0.7,-0.2],[1.0,1.0,4.0,0.0]])
+def test_gaussian_jac(pars):
+    x = np.linspace(-10,10,101)
+    np.testing.assert_allclose(utils.gaussian_jac(x,*pars),finite_difference_jac(utils.gaussian,x,pars),
+                               rtol=1e-5,atol=1e-8)
+
+
+def test_gaussfit():
+    rng = np.random.default_rng(2)
+    x = np.arange(-20.0,21.0)
+    truth = [3.0,1.3,2.2,0.5]
+    y = utils.gaussian(x,*truth) + rng.normal(0,0.01,len(x))
+    sigma = np.full(len(x),0.01)
+    pars,cov = utils.gaussfit(x,y,[2.0,0.0,1.0,0.0],sigma)
+    perror = np.sqrt(np.diag(cov))
+    assert np.all(np.abs(pars-truth) < 5*perror)
+    # A robust fit ignores an outlier
+    y[5] += 10
+    pars,cov = utils.gaussfit(x,y,[2.0,0.0,1.0,0.0],sigma,loss='soft_l1')
+    assert np.all(np.abs(pars-truth) < 10*perror)
+
+
+def test_closest_index():
+    arr = np.array([1.0,2.0,4.0,8.0])
+    assert utils.closest_index(arr,-5.0) == 0
+    assert utils.closest_index(arr,1.0) == 0
+    assert utils.closest_index(arr,2.9) == 1
+    assert utils.closest_index(arr,3.0) == 1   # ties go to the lower index
+    assert utils.closest_index(arr,3.1) == 2
+    assert utils.closest_index(arr,8.0) == 3
+    assert utils.closest_index(arr,100.0) == 3
+    wave = np.linspace(5000,6000,1001)
+    for val in [4999.0,5000.3,5500.55,5999.9,6010.0]:
+        assert utils.closest_index(wave,val) == np.argmin(np.abs(wave-val))
+
+
+def test_rebin():
+    arr = np.arange(10.0)
+    np.testing.assert_allclose(utils.rebin(arr,5),[0.5,2.5,4.5,6.5,8.5])
+    np.testing.assert_allclose(utils.rebin(arr,1),[4.5])
+    np.testing.assert_allclose(utils.rebin(arr,10),arr)
+    # Length not a multiple of the number of bins
+    np.testing.assert_allclose(utils.rebin(arr,3),[1.0,4.0,7.5])
+    # 2D arrays are rebinned along the first dimension
+    arr2 = np.vstack((arr,10*arr)).T
+    np.testing.assert_allclose(utils.rebin(arr2,5),np.vstack((utils.rebin(arr,5),10*utils.rebin(arr,5))).T)
+    for nbin in [0,11]:
+        with pytest.raises(ValueError):
+            utils.rebin(arr,nbin)
+
+
+@pytest.mark.parametrize('percentile',[0.0,50.0,95.0,100.0])
+def test_binned_percentile(percentile):
+    rng = np.random.default_rng(3)
+    x = rng.uniform(-1,1,1000)
+    y = rng.normal(size=1000)
+    # No points in one bin, and all-NaN values in another
+    x = x[(x<-0.5) | (x>-0.3)]
+    y = y[0:len(x)]
+    y[(x>0.3) & (x<0.4)] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore',RuntimeWarning)
+        ybin1,edges1,_ = bindata.binned_statistic(x,y,statistic='percentile',bins=20,percentile=percentile)
+    ybin2,edges2,binnumber = utils.binned_percentile(x,y,20,percentile=percentile)
+    np.testing.assert_allclose(edges2,edges1)
+    np.testing.assert_allclose(ybin2,ybin1,equal_nan=True)
+    assert np.sum(np.isnan(ybin2)) >= 2
+    # Reusing the bin numbers gives the same result
+    ybin3,_,_ = utils.binned_percentile(x,y,20,percentile=percentile,binnumber=binnumber)
+    np.testing.assert_array_equal(ybin3,ybin2)
+
+
+@pytest.mark.parametrize('wave',[np.linspace(15000,16000,300)**1.01,np.linspace(6000,5000,300)])
+def test_dispersion_interp(wave):
+    x = np.array([-5.0,0.0,10.3,150.7,299.0,310.0])
+    for extrapolate in [True,False]:
+        w1 = utils.p2w(wave,x,extrapolate=extrapolate)
+        w2 = utils.p2w(wave,x,extrapolate=extrapolate,interp=utils.dispersion_interp(wave))
+        np.testing.assert_array_equal(w1,w2)
+        x1 = utils.w2p(wave,w1,extrapolate=extrapolate)
+        x2 = utils.w2p(wave,w1,extrapolate=extrapolate,interp=utils.dispersion_interp(wave,inverse=True))
+        np.testing.assert_array_equal(x1,x2)
+    # Round trip within the dispersion solution
+    inside = (x>=0) & (x<=299)
+    np.testing.assert_allclose(utils.w2p(wave,utils.p2w(wave,x[inside])),x[inside],atol=1e-4)
+    np.testing.assert_allclose(utils.p2w(wave,np.arange(300.0)),wave)
+    # Extrapolation is off, NaN outside the range
+    assert np.all(np.isnan(utils.p2w(wave,x[~inside],extrapolate=False)))